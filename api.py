@@ -0,0 +1,89 @@
+from flask import url_for
+from models import db, Book, Cover
+
+# Сериализация книг для JSON API: проекция полей (fields=) и подгрузка
+# связей (include=) через selectinload — фиксированное число запросов на ответ
+
+BOOK_COLUMNS = {
+    'id': (Book.id,),
+    'title': (Book.title,),
+    'author': (Book.author,),
+    'publisher': (Book.publisher,),
+    'year': (Book.year,),
+    'pages': (Book.pages,),
+    # Наружу отдаётся очищенный HTML, а не исходный текст
+    'description': (Book.description_html,),
+    'excerpt': (Book.description_excerpt,),
+    'avg_rating': (Book.reviews_count, Book.rating_sum),
+    'reviews_count': (Book.reviews_count,),
+    'updated_at': (Book.updated_at,),
+}
+DEFAULT_FIELDS = ('id', 'title', 'author', 'publisher', 'year', 'pages', 'avg_rating', 'reviews_count')
+# Поля, значение которых берётся из колонки с другим именем
+ATTRIBUTES = {'description': 'description_html', 'excerpt': 'description_excerpt'}
+INCLUDES = ('genres', 'covers', 'reviews', 'similar')
+MAX_BATCH = 100
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def parse_list(value, allowed, default=()):
+    if not value:
+        return tuple(default)
+    items = tuple(dict.fromkeys(v.strip() for v in value.split(',') if v.strip()))
+    unknown = [v for v in items if v not in allowed]
+    if unknown:
+        raise BadRequest(f'Неизвестные значения: {", ".join(unknown)}')
+    return items
+
+
+def parse_ids(value):
+    try:
+        ids = [int(v) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise BadRequest('ids должен быть списком целых чисел')
+    if len(ids) > MAX_BATCH:
+        raise BadRequest(f'Не больше {MAX_BATCH} книг за запрос')
+    return list(dict.fromkeys(ids))
+
+
+def query_options(fields, includes):
+    # year и id нужны для курсора пагинации
+    columns = {Book.id, Book.year}
+    for field in fields:
+        columns.update(BOOK_COLUMNS[field])
+    if 'reviews' in includes:
+        columns.update(BOOK_COLUMNS['avg_rating'])
+    options = [db.load_only(*columns), db.noload(Book.collections)]
+    # Жанры по умолчанию грузятся подзапросом; если не нужны — не грузим
+    options.append(db.selectinload(Book.genres) if 'genres' in includes else db.noload(Book.genres))
+    if 'covers' in includes:
+        options.append(db.selectinload(Book.covers).selectinload(Cover.variants))
+    return options
+
+
+def _cover_url(md5_hash, filename):
+    return url_for('cover_file', md5_hash=md5_hash, filename=filename)
+
+
+def serialize_book(book, fields, includes, similar=None):
+    data = {}
+    for field in fields:
+        value = getattr(book, ATTRIBUTES.get(field, field))
+        data[field] = value.isoformat() if field == 'updated_at' else value
+    if 'genres' in includes:
+        data['genres'] = [{'id': g.id, 'name': g.name} for g in book.genres]
+    if 'covers' in includes:
+        data['covers'] = [{
+            'url': _cover_url(c.md5_hash, c.filename),
+            'variants': [{'url': _cover_url(v.md5_hash, v.filename), 'width': v.width,
+                          'height': v.height, 'format': v.format} for v in c.variants],
+        } for c in book.covers]
+    if 'reviews' in includes:
+        # Сводка берётся из денормализованных агрегатов, без запроса к reviews
+        data['reviews'] = {'count': book.reviews_count, 'avg_rating': book.avg_rating}
+    if 'similar' in includes:
+        data['similar'] = similar or []
+    return data
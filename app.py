@@ -1,17 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort, send_from_directory, get_template_attribute, Response, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from werkzeug.utils import secure_filename
-import os
-import hashlib
-import bleach
+import hmac
+import click
+import contextvars
+import time
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
 from config import Config
-from models import db, User, Book, Genre, Cover, Review, Role, Collection
+from models import db, User, Book, Genre, Cover, CoverVariant, Review, Role, Collection, ChangeMarker, BookPopularity, book_collections
 from forms import LoginForm, BookForm, ReviewForm, CollectionForm
+import database
+import migrations
+import query_plans
+import search
+import importer
+import exporter
+import api
+import recommendations
+import popularity
+import covers
+import http_cache
+from page_cache import page_cache
+from identity import identity_cache
+from metrics import metrics
+from passwords import password_hasher, login_throttle, HasherBusy
+from assets import static_assets, build_assets
+from popularity import view_counter
+from pagination import keyset_paginate, InvalidCursor
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+database.configure(app)
 db.init_app(app)
+page_cache.init_app(app)
+identity_cache.init_app(app)
+metrics.init_app(app)
+password_hasher.init_app(app)
+login_throttle.init_app(app)
+static_assets.init_app(app)
+view_counter.init_app(app)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -20,70 +48,236 @@ login_manager.login_message = 'Для выполнения данного дей
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return identity_cache.load_user(int(user_id))
+
+SEED_ROLES = [
+    ('Администратор', 'Суперпользователь, имеет полный доступ к системе'),
+    ('Модератор', 'Может редактировать данные книг и производить модерацию рецензий'),
+    ('Пользователь', 'Может оставлять рецензии')
+]
+SEED_USERS = [
+    # логин, пароль, роль, фамилия, имя, отчество
+    ('admin', 'admin', 'Администратор', 'Администратор', 'Система', None),
+    ('moderator', 'moderator123', 'Модератор', 'Модераторов', 'Иван', 'Петрович'),
+    ('user1', 'user123', 'Пользователь', 'Иванов', 'Алексей', 'Сергеевич'),
+]
+SEED_GENRES = ['Художественная литература', 'Научная литература', 'Фантастика', 'Детектив', 'Роман', 'Поэзия']
+
+def _seed():
+    # По одному запросу на таблицу: выбираем уже существующие записи и вставляем недостающие.
+    # Пароли хэшируются только для новых пользователей — на готовой базе старт ничего не пишет.
+    existing = set(db.session.scalars(db.select(Role.name)))
+    db.session.add_all(Role(name=name, description=description)
+                       for name, description in SEED_ROLES if name not in existing)
+    existing = set(db.session.scalars(db.select(Genre.name)))
+    db.session.add_all(Genre(name=name) for name in SEED_GENRES if name not in existing)
+    
+    logins = [row[0] for row in SEED_USERS]
+    existing = set(db.session.scalars(db.select(User.login).where(User.login.in_(logins))))
+    missing = [row for row in SEED_USERS if row[0] not in existing]
+    if missing:
+        db.session.flush()
+        role_ids = dict(db.session.execute(db.select(Role.name, Role.id)).all())
+        for login, password, role, last_name, first_name, middle_name in missing:
+            user = User(login=login, last_name=last_name, first_name=first_name,
+                        middle_name=middle_name, role_id=role_ids[role])
+            user.set_password(password)
+            db.session.add(user)
+    
+    if db.session.new:
+        # Несколько процессов могут стартовать одновременно: недостающее вставит первый
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
 
 def init_db():
     with app.app_context():
         db.create_all()
+        migrations.upgrade()
+        _seed()
         
-        # Создаем роли
-        roles = [
-            ('Администратор', 'Суперпользователь, имеет полный доступ к системе'),
-            ('Модератор', 'Может редактировать данные книг и производить модерацию рецензий'),
-            ('Пользователь', 'Может оставлять рецензии')
-        ]
-        
-        for role_name, description in roles:
-            if not Role.query.filter_by(name=role_name).first():
-                role = Role(name=role_name, description=description)
-                db.session.add(role)
-        
-        # Создаем администратора
-        if not User.query.filter_by(login='admin').first():
-            admin_role = Role.query.filter_by(name='Администратор').first()
-            admin = User(
-                login='admin',
-                last_name='Администратор',
-                first_name='Система',
-                role_id=admin_role.id
-            )
-            admin.set_password('admin')
-            db.session.add(admin)
-        
-        # Создаем модератора
-        if not User.query.filter_by(login='moderator').first():
-            moderator_role = Role.query.filter_by(name='Модератор').first()
-            moderator = User(
-                login='moderator',
-                last_name='Модераторов',
-                first_name='Иван',
-                middle_name='Петрович',
-                role_id=moderator_role.id
-            )
-            moderator.set_password('moderator123')
-            db.session.add(moderator)
-        
-        # Создаем пользователя
-        if not User.query.filter_by(login='user1').first():
-            user_role = Role.query.filter_by(name='Пользователь').first()
-            user1 = User(
-                login='user1',
-                last_name='Иванов',
-                first_name='Алексей',
-                middle_name='Сергеевич',
-                role_id=user_role.id
-            )
-            user1.set_password('user123')
-            db.session.add(user1)
-        
-        # Создаем жанры
-        genres = ['Художественная литература', 'Научная литература', 'Фантастика', 'Детектив', 'Роман', 'Поэзия']
-        for genre_name in genres:
-            if not Genre.query.filter_by(name=genre_name).first():
-                genre = Genre(name=genre_name)
-                db.session.add(genre)
-        
-        db.session.commit()
+        # Локальная реплика создаётся копией основной базы
+        if app.config['DATABASE_REPLICA_URL'] == 'local':
+            database.sync_replica(db.engines[None], db.engines[database.REPLICA])
+
+def prepare_app():
+    # Подготовка к запуску перед стартом сервера (flask serve, gunicorn 'app:prepare_app()').
+    # Это не фабрика: приложение одно на модуль, маршруты регистрируются при импорте,
+    # и каждый вызов возвращает тот же app. Здесь только готовится база.
+    init_db()
+    with app.app_context():
+        # Соединения мастера не должны достаться воркерам после fork
+        for engine in db.engines.values():
+            engine.dispose()
+    return app
+
+def after_fork():
+    # Вызывается в воркере сразу после fork
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    page_cache.after_fork()
+
+@app.cli.command('serve')
+@click.option('--bind', default=lambda: app.config['SERVE_BIND'], show_default='SERVE_BIND', help='Адрес и порт')
+@click.option('--workers', type=int, default=lambda: app.config['SERVE_WORKERS'], show_default='SERVE_WORKERS')
+@click.option('--threads', default=1, show_default=True, help='Потоков в воркере (больше 1 — воркеры gthread)')
+@click.option('--timeout', default=30, show_default=True, help='Через сколько секунд зависший воркер перезапускается')
+@click.option('--max-requests', default=0, show_default=True, help='Перезапускать воркер после N запросов (0 — нет)')
+@click.option('--memory-report', default=0, show_default=True, help='Как часто воркеры пишут в лог свою память, секунды')
+def serve_command(bind, workers, threads, timeout, max_requests, memory_report):
+    """Запустить приложение в gunicorn с предзагрузкой и несколькими воркерами."""
+    import server
+    if workers > 1 and app.config['PAGE_CACHE_BACKEND'] == 'memory':
+        click.echo('Кэш страниц в памяти у каждого воркера свой и сбрасывается только в одном из них; '
+                   'для нескольких воркеров используйте PAGE_CACHE_BACKEND=sqlite')
+    options = {
+        'bind': bind,
+        'workers': workers,
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'timeout': timeout,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'preload_app': True,
+    }
+    # Команды flask выполняются внутри контекста приложения. Воркеры не должны его
+    # унаследовать, иначе g был бы общим для всех запросов, поэтому сервер
+    # запускается в пустом контексте
+    contextvars.Context().run(server.Server(prepare_app, options, after_fork=after_fork,
+                                            memory_report=memory_report).run)
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Применить недостающие миграции схемы."""
+    db.create_all()
+    if not migrations.upgrade(report=print):
+        print('Схема актуальна')
+
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    """Проверить, что запросы основных страниц не просматривают таблицы целиком."""
+    book_id = db.session.scalar(db.select(Book.id).order_by(Book.id))
+    role_users = dict(db.session.execute(
+        db.select(Role.name, db.func.min(User.id)).join(User, User.role_id == Role.id).group_by(Role.name)
+    ).all())
+    collection_id, owner_id = db.session.execute(
+        db.select(Collection.id, Collection.user_id).order_by(Collection.id)
+    ).first() or (None, None)
+    if book_id is None:
+        raise click.ClickException('В каталоге нет книг')
+    user_id = role_users.get('Пользователь')
+    pages = [
+        (None, '/'), (None, '/?page=2'), (None, f'/book/{book_id}'), (None, '/search?q=книга'),
+        (None, '/api/books?include=genres,covers,reviews,similar'), (None, f'/api/books/{book_id}'),
+        (user_id, f'/book/{book_id}'), (user_id, '/collections'),
+        (role_users.get('Модератор'), '/moderation/reviews'),
+    ]
+    if collection_id:
+        pages.append((owner_id, f'/collections/{collection_id}'))
+    problems = query_plans.check(app, pages)
+    for url, table, statement in problems:
+        print(f'{url}: полный просмотр {table}\n    {statement}')
+    if problems:
+        raise click.ClickException(f'Запросов без индекса: {len(problems)}')
+    print(f'Проверено страниц: {len(pages)}, все запросы используют индексы')
+
+@app.cli.command('sync-replica')
+def sync_replica_command():
+    """Скопировать основную SQLite-базу в файл локальной реплики."""
+    if database.REPLICA not in db.engines:
+        raise click.ClickException('Реплика не настроена (DATABASE_REPLICA_URL)')
+    database.sync_replica(db.engines[None], db.engines[database.REPLICA])
+    print('Реплика обновлена')
+
+@app.cli.command('recompute-stats')
+def recompute_stats_command():
+    """Пересчитать количество рецензий и сумму оценок для всех книг."""
+    migrations.upgrade()
+    Book.recompute_review_stats()
+    db.session.commit()
+    print('Статистика рецензий пересчитана')
+
+@app.cli.command('recompute-popularity')
+def recompute_popularity_command():
+    """Пересчитать просмотры за всё время и за последние дни по дневной таблице."""
+    popularity.rebuild(view_counter.window_start())
+    db.session.commit()
+    print('Популярность книг пересчитана')
+
+@app.cli.command('render-texts')
+@click.option('--all', 'all_rows', is_flag=True, help='Пересчитать все строки, а не только без готового HTML')
+def render_texts_command(all_rows):
+    """Заполнить готовый HTML и выжимки описаний книг и текстов рецензий."""
+    migrations.upgrade()
+    books = Book.render_descriptions(only_missing=not all_rows)
+    reviews = Review.render_texts(only_missing=not all_rows)
+    ChangeMarker.touch(ChangeMarker.CATALOGUE)
+    db.session.commit()
+    print(f'Обработано описаний: {books}, рецензий: {reviews}')
+
+@app.cli.command('reindex-search')
+def reindex_search_command():
+    """Перестроить полнотекстовый индекс каталога."""
+    search.ensure_index()
+    search.reindex_all()
+    db.session.commit()
+    print('Поисковый индекс перестроен')
+
+@app.cli.command('build-cover-variants')
+def build_cover_variants_command():
+    """Построить недостающие миниатюры для всех обложек."""
+    for md5_hash, filename in db.session.query(Cover.md5_hash, db.func.min(Cover.filename)).group_by(Cover.md5_hash):
+        covers.build_variants(md5_hash, filename)
+    print('Миниатюры обложек построены')
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Собрать css/js с хэшем содержимого в имени и сжатыми вариантами (gzip, brotli)."""
+    # Обложки уже адресуются по md5 (/covers/<md5>/...) и сжаты форматом изображения
+    manifest = build_assets(app.static_folder, app.config['ASSETS_FOLDER'],
+                            skip=[app.config['UPLOAD_FOLDER']], report=click.echo)
+    click.echo(f'Файлов в манифесте: {len(manifest)}')
+
+@app.cli.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Формат файла (по умолчанию по расширению)')
+@click.option('--batch-size', default=1000, show_default=True, help='Сколько книг вставлять за один коммит')
+@click.option('--dry-run', is_flag=True, help='Только проверить данные, ничего не записывая')
+@click.option('--restart', is_flag=True, help='Начать заново, игнорируя сохранённый прогресс')
+@click.option('--workers', type=int, help='Число процессов для хэширования обложек')
+def import_books_command(path, fmt, batch_size, dry_run, restart, workers):
+    """Импортировать каталог книг из CSV или JSONL."""
+    progress = importer.import_books(path, fmt=fmt, batch_size=batch_size, dry_run=dry_run,
+                                     restart=restart, workers=workers)
+    page_cache.invalidate_catalogue()
+    if dry_run:
+        print(f"Проверено строк: {progress['rows']}, с ошибками: {progress['skipped']}")
+    else:
+        print(f"Импортировано книг: {progress['imported']}, пропущено строк: {progress['skipped']}")
+        print('Для новых обложек запустите flask build-cover-variants')
+
+@app.cli.command('export')
+@click.argument('kind', type=click.Choice(sorted(exporter.EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(sorted(exporter.FORMATS)), default='csv', show_default=True)
+@click.option('--since', type=click.DateTime(), help='Только рецензии, созданные после этой даты')
+@click.option('--since-id', type=int, help='Только книги/подборки с id больше указанного')
+@click.option('-o', '--output', type=click.File('w', encoding='utf-8'), default='-')
+def export_command(kind, fmt, since, since_id, output):
+    """Выгрузить книги, рецензии или состав подборок в CSV/JSONL."""
+    for chunk in exporter.export(kind, fmt, since=since, since_id=since_id):
+        output.write(chunk)
+
+@app.cli.command('recommend')
+@click.option('--full', is_flag=True, help='Полный пересчёт вместо инкрементального')
+def recommend_command(full):
+    """Пересчитать похожие книги."""
+    if full:
+        count = recommendations.rebuild()
+    else:
+        count = recommendations.refresh()
+    print(f'Пересчитаны рекомендации для {count} книг')
 
 def allowed_file(filename):
     return '.' in filename and \
@@ -91,52 +285,108 @@ def allowed_file(filename):
 
 def save_cover(file, book_id):
     if file and allowed_file(file.filename):
-        file_content = file.read()
-        md5_hash = hashlib.md5(file_content).hexdigest()
-        
-        existing_cover = Cover.query.filter_by(md5_hash=md5_hash).first()
-        if existing_cover:
-            return existing_cover.id
-        
-        cover = Cover(
-            filename=secure_filename(file.filename),
-            mime_type=file.mimetype,
-            md5_hash=md5_hash,
-            book_id=book_id
-        )
-        db.session.add(cover)
-        db.session.flush()
-        
-        filename = f"{cover.id}.{file.filename.rsplit('.', 1)[1].lower()}"
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        with open(file_path, 'wb') as f:
-            f.write(file_content)
-        
-        cover.filename = filename
-        return cover.id
+        return covers.store_upload(file, book_id)
     return None
 
+def current_role_name():
+    if not current_user.is_authenticated:
+        return 'anon'
+    return identity_cache.role_name(current_user.role_id)
+
 def has_permission(required_roles):
     if not current_user.is_authenticated:
         return False
-    return current_user.role.name in required_roles
+    return identity_cache.role_name(current_user.role_id) in required_roles
 
 @app.route('/')
+@database.read_only
 def index():
-    page = request.args.get('page', 1, type=int)
-    books = Book.query.order_by(Book.year.desc()).paginate(
-        page=page, per_page=10, error_out=False)
+    changed_at = ChangeMarker.get(ChangeMarker.CATALOGUE)
+    # Списки лидеров перестраиваются не чаще раза в POPULAR_REFRESH_SECONDS
+    refresh = app.config['POPULAR_REFRESH_SECONDS']
+    popular_at = datetime.utcfromtimestamp(int(time.time()) // refresh * refresh)
+    last_modified = max(changed_at, popular_at) if changed_at else popular_at
+    etag = http_cache.make_etag('index', changed_at, popular_at, request.query_string)
+    cached = http_cache.not_modified(etag, last_modified)
+    if cached:
+        return cached
+    
+    key = f'index:{current_role_name()}:{changed_at}:{request.query_string.decode()}'
+    catalogue = page_cache.get_or_render(key, render_catalogue)
+    popular = page_cache.get_or_render(f'popular:{popular_at.isoformat()}', render_popular)
+    return http_cache.with_validators(
+        render_template('index.html', catalogue=catalogue, popular=popular), etag, last_modified)
+
+def render_popular():
+    limit = app.config['POPULAR_LIMIT']
+    return render_template('_popular.html',
+                           most_viewed=popularity.leaders(BookPopularity.total_views, limit),
+                           trending=popularity.leaders(BookPopularity.window_views, limit),
+                           window_days=app.config['POPULAR_WINDOW_DAYS'])
+
+def render_catalogue():
+    # Номер страницы — запасной OFFSET-режим для перехода на произвольную страницу
+    page = request.args.get('page', type=int)
+    # Карточкам хватает выжимки, полные тексты описаний не читаем
+    query = Book.query.options(db.defer(Book.description), db.defer(Book.description_html))
+    if page:
+        books = query.order_by(Book.year.desc(), Book.id.desc()).paginate(
+            page=page, per_page=10, error_out=False)
+    else:
+        try:
+            books = keyset_paginate(query, [Book.year, Book.id], 10,
+                                    after=request.args.get('after'),
+                                    before=request.args.get('before'), model=Book)
+        except InvalidCursor:
+            abort(400)
+    
+    return render_template('_catalogue.html', books=books, keyset=not page)
+
+@app.route('/search')
+@database.read_only
+def search_view():
+    query = request.args.get('q', '').strip()
+    page = max(request.args.get('page', 1, type=int), 1)
+    genre_id = request.args.get('genre', type=int)
+    decade = request.args.get('decade', type=int)
     
-    for book in books.items:
-        reviews_count = Review.query.filter_by(book_id=book.id).count()
-        avg_rating = db.session.query(db.func.avg(Review.rating)).filter_by(book_id=book.id).scalar()
-        book.reviews_count = reviews_count
-        book.avg_rating = round(avg_rating, 1) if avg_rating else 0
+    result = search.search_books(query, genre_id=genre_id, decade=decade, page=page)
     
-    return render_template('index.html', books=books)
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'query': result['query'],
+            'total': result['total'],
+            'page': result['page'],
+            'pages': result['pages'],
+            'books': [{
+                'id': book.id,
+                'title': book.title,
+                'author': book.author,
+                'publisher': book.publisher,
+                'year': book.year,
+                'genres': [g.name for g in book.genres],
+                'avg_rating': book.avg_rating,
+                'reviews_count': book.reviews_count,
+                'url': url_for('book_detail', book_id=book.id)
+            } for book in result['books']],
+            'facets': {'genres': result['genres'], 'decades': result['decades']}
+        })
+    
+    return render_template('search.html', result=result, genre_id=genre_id, decade=decade)
+
+def _rehash_saver(user_id, old_hash):
+    def save(new_hash):
+        with app.app_context():
+            # Если пароль успели сменить, новый хэш не записываем
+            updated = db.session.execute(
+                db.update(User).where(User.id == user_id, User.password_hash == old_hash)
+                .values(password_hash=new_hash)
+            ).rowcount
+            db.session.commit()
+            # UPDATE через Core не проходит через after_flush, кэш сбрасываем сами
+            if updated:
+                identity_cache.invalidate_user(user_id)
+    return save
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -145,11 +395,28 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
+        # Перебор отсекается до хэширования, чтобы не тратить на него процессор
+        wait = login_throttle.retry_after(form.login.data, request.remote_addr)
+        if wait:
+            flash(f'Слишком много попыток входа. Повторите через {wait} с')
+            return render_template('login.html', form=form), 429, {'Retry-After': str(wait)}
+        
         user = User.query.filter_by(login=form.login.data).first()
-        if user and user.check_password(form.password.data):
+        try:
+            valid = user is not None and password_hasher.check(user.password_hash, form.password.data)
+        except HasherBusy:
+            flash('Сервер перегружен, попробуйте войти через несколько секунд')
+            return render_template('login.html', form=form), 503, {'Retry-After': '2'}
+        
+        if valid:
+            login_throttle.succeeded(form.login.data)
+            if password_hasher.needs_rehash(user.password_hash):
+                # Хэш со старыми параметрами пересчитываем в пуле, пока пароль известен
+                password_hasher.rehash_later(form.password.data, _rehash_saver(user.id, user.password_hash))
             login_user(user, remember=form.remember_me.data)
             next_page = request.args.get('next')
             return redirect(next_page or url_for('index'))
+        login_throttle.failed(form.login.data, request.remote_addr)
         flash('Невозможно аутентифицироваться с указанными логином и паролем')
     
     return render_template('login.html', form=form)
@@ -161,19 +428,181 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/book/<int:book_id>')
+@database.read_only
 def book_detail(book_id):
-    book = Book.query.get_or_404(book_id)
-    reviews = Review.query.filter_by(book_id=book_id).order_by(Review.created_at.desc()).all()
+    # Для проверки ETag достаточно одной колонки, без загрузки книги и рецензий
+    updated_at = db.session.scalar(db.select(Book.updated_at).where(Book.id == book_id))
+    if updated_at is None:
+        abort(404)
+    # Просмотр засчитывается и при ответе 304; в базу счётчики пишутся пачками
+    view_counter.record(book_id)
+    updated_at = with_recommendations(updated_at)
+    etag = http_cache.make_etag('book', book_id, updated_at)
+    cached = http_cache.not_modified(etag, updated_at)
+    if cached:
+        return cached
+    
     user_review = None
     user_collections = []
     
     if current_user.is_authenticated:
         user_review = Review.query.filter_by(book_id=book_id, user_id=current_user.id).first()
-        if current_user.role.name == 'Пользователь':
-            user_collections = Collection.query.filter_by(user_id=current_user.id).all()
+        if current_role_name() == 'Пользователь':
+            user_collections = Collection.memberships(current_user.id, book_id)
+    
+    # Книгу и чужие рецензии рендерим из кэша; ключ включает версию книги
+    version = f'book:{book_id}:{updated_at.isoformat()}'
+    fragments = page_cache.get_or_render(f'{version}:info', lambda: render_book_fragments(book_id))
+    exclude_review_id = user_review.id if user_review else 0
+    reviews_html = page_cache.get_or_render(
+        f'{version}:reviews:{current_role_name()}:{exclude_review_id}',
+        lambda: render_book_reviews(book_id, exclude_review_id))
     
-    return render_template('book_detail.html', book=book, reviews=reviews, 
-                          user_review=user_review, user_collections=user_collections)
+    similar_books = recommendations.similar_books(book_id, limit=6)
+    
+    return http_cache.with_validators(
+        render_template('book_detail.html', book_id=book_id, fragments=fragments,
+                        reviews_html=reviews_html, user_review=user_review,
+                        user_collections=user_collections, similar_books=similar_books),
+        etag, updated_at)
+
+def with_recommendations(changed_at):
+    # Похожие книги пересчитываются отдельно от самих книг: версия страницы —
+    # более поздняя из двух отметок
+    recommended_at = ChangeMarker.get(ChangeMarker.RECOMMENDATIONS)
+    if recommended_at is None or changed_at is None:
+        return changed_at or recommended_at
+    return max(changed_at, recommended_at)
+
+def render_book_fragments(book_id):
+    book = Book.query.get_or_404(book_id)
+    return {
+        'cover': str(get_template_attribute('_book_fragments.html', 'cover')(book)),
+        'info': str(get_template_attribute('_book_fragments.html', 'info')(book)),
+    }
+
+def render_book_reviews(book_id, exclude_review_id):
+    reviews = Review.query.filter_by(book_id=book_id) \
+        .options(db.joinedload(Review.user), db.defer(Review.text)) \
+        .order_by(Review.created_at.desc()).all()
+    return render_template('_book_reviews.html', reviews=reviews, exclude_review_id=exclude_review_id)
+
+@app.route('/export/<kind>.<fmt>')
+@login_required
+@database.read_only
+def export_data(kind, fmt):
+    if not has_permission(['Администратор']):
+        abort(403)
+    if kind not in exporter.EXPORTS or fmt not in exporter.FORMATS:
+        abort(404)
+    
+    since = request.args.get('since')
+    if since:
+        try:
+            since = datetime.fromisoformat(since)
+        except ValueError:
+            abort(400)
+    
+    chunks = exporter.export(kind, fmt, since=since, since_id=request.args.get('since_id', type=int))
+    response = Response(stream_with_context(chunks), mimetype=exporter.FORMATS[fmt][1])
+    response.headers['Content-Disposition'] = f'attachment; filename={kind}.{fmt}'
+    return response
+
+@app.route('/cache/stats')
+@login_required
+def cache_stats():
+    if not has_permission(['Администратор']):
+        abort(403)
+    return jsonify(page_cache.stats())
+
+@app.route('/metrics')
+def metrics_view():
+    # Сборщик Prometheus авторизуется токеном, администратор — обычной сессией
+    token = app.config['METRICS_TOKEN']
+    authorized = token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not authorized and not has_permission(['Администратор']):
+        abort(403)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/books')
+@database.read_only
+def api_books():
+    try:
+        fields = api.parse_list(request.args.get('fields'), api.BOOK_COLUMNS, api.DEFAULT_FIELDS)
+        includes = api.parse_list(request.args.get('include'), api.INCLUDES)
+        ids = api.parse_ids(request.args['ids']) if 'ids' in request.args else None
+    except api.BadRequest as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    changed_at = ChangeMarker.get(ChangeMarker.CATALOGUE)
+    if 'similar' in includes:
+        changed_at = with_recommendations(changed_at)
+    etag = http_cache.make_etag('api-books', changed_at, request.query_string)
+    cached = http_cache.not_modified(etag, changed_at, shared=True)
+    if cached:
+        return cached
+    
+    query = Book.query.options(*api.query_options(fields, includes))
+    if ids is not None:
+        found = {book.id: book for book in query.filter(Book.id.in_(ids))}
+        similar = recommendations.similar_for(list(found)) if 'similar' in includes else {}
+        payload = {
+            'books': [api.serialize_book(found[i], fields, includes, similar.get(i)) for i in ids if i in found],
+            'missing': [i for i in ids if i not in found],
+        }
+    else:
+        limit = min(max(request.args.get('limit', 20, type=int), 1), api.MAX_BATCH)
+        try:
+            page = keyset_paginate(query, [Book.year, Book.id], limit,
+                                   after=request.args.get('after'),
+                                   before=request.args.get('before'))
+        except InvalidCursor:
+            return jsonify({'success': False, 'message': 'Некорректный курсор'}), 400
+        similar = recommendations.similar_for([b.id for b in page.items]) if 'similar' in includes else {}
+        payload = {
+            'books': [api.serialize_book(book, fields, includes, similar.get(book.id)) for book in page.items],
+            'next': page.next_cursor,
+            'prev': page.prev_cursor,
+        }
+    
+    return http_cache.with_validators(jsonify(payload), etag, changed_at, shared=True)
+
+@app.route('/api/books/<int:book_id>')
+@database.read_only
+def api_book(book_id):
+    try:
+        fields = api.parse_list(request.args.get('fields'), api.BOOK_COLUMNS, api.BOOK_COLUMNS)
+        includes = api.parse_list(request.args.get('include'), api.INCLUDES, api.INCLUDES)
+    except api.BadRequest as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    
+    updated_at = db.session.scalar(db.select(Book.updated_at).where(Book.id == book_id))
+    if updated_at is None:
+        return jsonify({'success': False, 'message': 'Книга не найдена'}), 404
+    if 'similar' in includes:
+        updated_at = with_recommendations(updated_at)
+    etag = http_cache.make_etag('api-book', book_id, updated_at, request.query_string)
+    cached = http_cache.not_modified(etag, updated_at, shared=True)
+    if cached:
+        return cached
+    
+    book = Book.query.options(*api.query_options(fields, includes)).filter_by(id=book_id).one()
+    similar = recommendations.similar_books(book_id) if 'similar' in includes else None
+    return http_cache.with_validators(
+        jsonify(api.serialize_book(book, fields, includes, similar)), etag, updated_at, shared=True)
+
+@app.route('/covers/<md5_hash>/<path:filename>')
+def cover_file(md5_hash, filename):
+    # Хэш содержимого в URL делает файл неизменяемым, его можно кэшировать навсегда,
+    # поэтому отдаём файл только под хэшем той обложки или миниатюры, которой он принадлежит
+    owned = db.session.scalar(db.select(
+        db.exists().where(Cover.md5_hash == md5_hash, Cover.filename == filename)
+        | db.exists().where(CoverVariant.md5_hash == md5_hash, CoverVariant.filename == filename)))
+    if not owned:
+        abort(404)
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename,
+                                   max_age=http_cache.COVER_MAX_AGE)
+    return http_cache.immutable(response)
 
 @app.route('/book/add', methods=['GET', 'POST'])
 @login_required
@@ -189,12 +618,12 @@ def add_book():
         try:
             book = Book(
                 title=form.title.data,
-                description=bleach.clean(form.description.data),
                 year=form.year.data,
                 publisher=form.publisher.data,
                 author=form.author.data,
                 pages=form.pages.data
             )
+            book.set_description(form.description.data)
             
             selected_genres = Genre.query.filter(Genre.id.in_(form.genres.data)).all()
             book.genres = selected_genres
@@ -202,10 +631,16 @@ def add_book():
             db.session.add(book)
             db.session.flush()
             
+            cover = None
             if form.cover.data:
-                save_cover(form.cover.data, book.id)
+                cover = save_cover(form.cover.data, book.id)
             
+            search.index_book(book)
+            ChangeMarker.touch(ChangeMarker.CATALOGUE)
             db.session.commit()
+            page_cache.invalidate_catalogue()
+            if cover:
+                covers.schedule_variants(cover)
             flash('Книга успешно добавлена')
             return redirect(url_for('book_detail', book_id=book.id))
             
@@ -232,7 +667,7 @@ def edit_book(book_id):
     if form.validate_on_submit():
         try:
             book.title = form.title.data
-            book.description = bleach.clean(form.description.data)
+            book.set_description(form.description.data)
             book.year = form.year.data
             book.publisher = form.publisher.data
             book.author = form.author.data
@@ -241,7 +676,13 @@ def edit_book(book_id):
             selected_genres = Genre.query.filter(Genre.id.in_(form.genres.data)).all()
             book.genres = selected_genres
             
+            book.updated_at = datetime.utcnow()
+            
+            search.index_book(book)
+            ChangeMarker.touch(ChangeMarker.CATALOGUE)
             db.session.commit()
+            page_cache.invalidate_catalogue()
+            page_cache.invalidate_book(book_id)
             flash('Книга успешно обновлена')
             return redirect(url_for('book_detail', book_id=book.id))
             
@@ -262,12 +703,17 @@ def delete_book(book_id):
     
     try:
         for cover in book.covers:
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], cover.filename)
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            covers.delete_cover_files(cover)
         
+        search.remove_book(book.id)
+        recommendations.forget_book(book_id)
+        recommendations.mark_dirty(book_id)
+        popularity.forget_book(book_id)
+        ChangeMarker.touch(ChangeMarker.CATALOGUE)
         db.session.delete(book)
         db.session.commit()
+        page_cache.invalidate_catalogue()
+        page_cache.invalidate_book(book_id)
         flash('Книга успешно удалена')
     except Exception as e:
         db.session.rollback()
@@ -296,12 +742,17 @@ def add_review(book_id):
             review = Review(
                 book_id=book_id,
                 user_id=current_user.id,
-                rating=form.rating.data,
-                text=bleach.clean(form.text.data)
+                rating=form.rating.data
             )
+            review.set_text(form.text.data)
             
             db.session.add(review)
+            Book.bump_review_stats(book_id, 1, review.rating)
+            recommendations.mark_dirty(book_id)
+            ChangeMarker.touch(ChangeMarker.CATALOGUE)
             db.session.commit()
+            page_cache.invalidate_catalogue()
+            page_cache.invalidate_book(book_id)
             flash('Рецензия успешно добавлена')
             return redirect(url_for('book_detail', book_id=book_id))
             
@@ -323,8 +774,13 @@ def delete_review(review_id):
     book_id = review.book_id
     
     try:
+        Book.bump_review_stats(book_id, -1, -review.rating)
+        recommendations.mark_dirty(book_id)
+        ChangeMarker.touch(ChangeMarker.CATALOGUE)
         db.session.delete(review)
         db.session.commit()
+        page_cache.invalidate_catalogue()
+        page_cache.invalidate_book(book_id)
         flash('Рецензия успешно удалена')
     except Exception as e:
         db.session.rollback()
@@ -333,6 +789,40 @@ def delete_review(review_id):
     return redirect(url_for('book_detail', book_id=book_id))
 
 # НОВЫЙ МАРШРУТ: Страница управления рецензиями для модераторов
+MODERATION_FILTERS = ('status', 'rating', 'date_from', 'date_to', 'book', 'author', 'q', 'per_page')
+MODERATION_PAGE_SIZES = (20, 50, 100, 200)
+
+def moderation_query(filters):
+    # Рецензент и книга подгружаются тем же запросом, что и список (contains_eager)
+    query = Review.query.join(Review.book).join(Review.user).options(
+        db.contains_eager(Review.book).load_only(Book.id, Book.title, Book.author),
+        db.contains_eager(Review.user).load_only(User.id, User.last_name, User.first_name, User.middle_name),
+        db.defaultload(Review.book).noload(Book.genres),
+    )
+    status = filters.get('status', 'pending')
+    if status == 'pending':
+        query = query.filter(Review.moderated_at.is_(None))
+    elif status == 'approved':
+        query = query.filter(Review.moderated_at.isnot(None))
+    if filters.get('rating', '').isdigit():
+        query = query.filter(Review.rating == int(filters['rating']))
+    try:
+        if filters.get('date_from'):
+            query = query.filter(Review.created_at >= datetime.fromisoformat(filters['date_from']))
+        if filters.get('date_to'):
+            # Дата «по» включительно
+            date_to = datetime.fromisoformat(filters['date_to'])
+            query = query.filter(Review.created_at < date_to + timedelta(days=1))
+    except ValueError:
+        abort(400)
+    if filters.get('book'):
+        query = query.filter(Book.title.contains(filters['book'], autoescape=True))
+    if filters.get('author'):
+        query = query.filter(Book.author.contains(filters['author'], autoescape=True))
+    if filters.get('q'):
+        query = query.filter(Review.text.contains(filters['q'], autoescape=True))
+    return query
+
 @app.route('/moderation/reviews')
 @login_required
 def moderation_reviews():
@@ -340,30 +830,85 @@ def moderation_reviews():
         flash('У вас недостаточно прав для выполнения данного действия')
         return redirect(url_for('index'))
     
-    page = request.args.get('page', 1, type=int)
-    reviews = Review.query.order_by(Review.created_at.desc()).paginate(
-        page=page, per_page=20, error_out=False)
+    filters = {key: request.args[key].strip() for key in MODERATION_FILTERS if request.args.get(key, '').strip()}
+    per_page = request.args.get('per_page', type=int)
+    per_page = per_page if per_page in MODERATION_PAGE_SIZES else MODERATION_PAGE_SIZES[0]
+    query = moderation_query(filters)
     
-    return render_template('moderation_reviews.html', reviews=reviews)
+    page = request.args.get('page', type=int)
+    if page:
+        reviews = query.order_by(Review.created_at.desc(), Review.id.desc()).paginate(
+            page=page, per_page=per_page, error_out=False)
+    else:
+        try:
+            reviews = keyset_paginate(query, [Review.created_at, Review.id], per_page,
+                                      after=request.args.get('after'),
+                                      before=request.args.get('before'))
+        except InvalidCursor:
+            abort(400)
+    
+    return render_template('moderation_reviews.html', reviews=reviews, keyset=not page,
+                           filters=filters, page_sizes=MODERATION_PAGE_SIZES)
+
+@app.route('/moderation/reviews/bulk', methods=['POST'])
+@login_required
+def moderate_reviews_bulk():
+    if not has_permission(['Модератор', 'Администратор']):
+        flash('У вас недостаточно прав для выполнения данного действия')
+        return redirect(url_for('index'))
+    
+    action = request.form.get('action')
+    try:
+        review_ids = list(dict.fromkeys(int(v) for v in request.form.getlist('review_ids')))
+    except ValueError:
+        abort(400)
+    next_url = request.form.get('next', '')
+    back = redirect(next_url if next_url.startswith('/') and not next_url.startswith('//')
+                    else url_for('moderation_reviews'))
+    if action not in ('delete', 'approve') or not review_ids:
+        flash('Выберите рецензии и действие')
+        return back
+    if len(review_ids) > app.config['MODERATION_BULK_MAX']:
+        flash(f"За один раз можно обработать не больше {app.config['MODERATION_BULK_MAX']} рецензий")
+        return back
+    
+    # Всё действие — одна транзакция; агрегаты книг обновляются по разу на книгу
+    try:
+        if action == 'delete':
+            deleted, book_ids = Review.delete_many(review_ids)
+            if book_ids:
+                recommendations.mark_dirty(*book_ids)
+                ChangeMarker.touch(ChangeMarker.CATALOGUE)
+            db.session.commit()
+            page_cache.invalidate_catalogue()
+            for book_id in book_ids:
+                page_cache.invalidate_book(book_id)
+            flash(f'Удалено рецензий: {deleted}')
+        else:
+            approved = Review.approve_many(review_ids)
+            db.session.commit()
+            flash(f'Одобрено рецензий: {approved}')
+    except Exception as e:
+        db.session.rollback()
+        flash('При обработке рецензий возникла ошибка')
+    
+    return back
 
 @app.route('/collections')
 @login_required
 def collections():
-    if current_user.role.name != 'Пользователь':
+    if current_role_name() != 'Пользователь':
         flash('У вас недостаточно прав для выполнения данного действия')
         return redirect(url_for('index'))
     
-    user_collections = Collection.query.filter_by(user_id=current_user.id).all()
-    
-    for collection in user_collections:
-        collection.books_count = len(collection.books)
+    user_collections = Collection.with_counts(current_user.id)
     
     return render_template('collections.html', collections=user_collections)
 
 @app.route('/collections/add', methods=['POST'])
 @login_required
 def add_collection():
-    if current_user.role.name != 'Пользователь':
+    if current_role_name() != 'Пользователь':
         return jsonify({'success': False, 'message': 'Недостаточно прав'})
     
     name = request.json.get('name')
@@ -384,34 +929,102 @@ def add_collection():
 def collection_detail(collection_id):
     collection = Collection.query.get_or_404(collection_id)
     
-    if collection.user_id != current_user.id and current_user.role.name != 'Администратор':
+    if collection.user_id != current_user.id and current_role_name() != 'Администратор':
         flash('У вас нет доступа к этой подборке')
         return redirect(url_for('collections'))
     
-    return render_template('collection_detail.html', collection=collection)
+    # Большие подборки выводятся постранично, без загрузки всего состава
+    query = Book.query.join(book_collections, book_collections.c.book_id == Book.id) \
+        .filter(book_collections.c.collection_id == collection_id)
+    try:
+        books = keyset_paginate(query, [Book.id], 20, after=request.args.get('after'),
+                                before=request.args.get('before'))
+    except InvalidCursor:
+        abort(400)
+    
+    return render_template('collection_detail.html', collection=collection, books=books,
+                           books_count=Collection.books_count(collection_id))
+
+def _own_collection_or_error(collection_id):
+    owner_id = db.session.scalar(db.select(Collection.user_id).where(Collection.id == collection_id))
+    if owner_id is None:
+        abort(404)
+    if owner_id != current_user.id:
+        return jsonify({'success': False, 'message': 'Недостаточно прав'})
+    return None
+
+def _book_ids_from_request():
+    book_ids = (request.get_json(silent=True) or {}).get('book_ids')
+    if not isinstance(book_ids, list) or not book_ids:
+        return None
+    try:
+        book_ids = list(dict.fromkeys(int(book_id) for book_id in book_ids))
+    except (TypeError, ValueError):
+        return None
+    return book_ids if len(book_ids) <= app.config['COLLECTION_BULK_MAX'] else None
 
 @app.route('/collections/<int:collection_id>/add_book', methods=['POST'])
 @login_required
 def add_book_to_collection(collection_id):
-    collection = Collection.query.get_or_404(collection_id)
+    error = _own_collection_or_error(collection_id)
+    if error:
+        return error
     
-    if collection.user_id != current_user.id:
-        return jsonify({'success': False, 'message': 'Недостаточно прав'})
-    
-    book_id = request.json.get('book_id')
-    book = Book.query.get_or_404(book_id)
+    # Проверяем только существование книги, без загрузки её самой и жанров
+    book_id = db.session.query(Book.id).filter_by(id=request.json.get('book_id')).scalar()
+    if book_id is None:
+        abort(404)
     
     try:
-        if book in collection.books:
+        if not Collection.add_books(collection_id, [book_id]):
             return jsonify({'success': False, 'message': 'Книга уже в подборке'})
         
-        collection.books.append(book)
+        recommendations.mark_dirty(book_id)
         db.session.commit()
         return jsonify({'success': True, 'message': 'Книга успешно добавлена в подборку'})
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'message': 'Ошибка при добавлении книги'})
 
+@app.route('/collections/<int:collection_id>/add_books', methods=['POST'])
+@login_required
+def add_books_to_collection(collection_id):
+    error = _own_collection_or_error(collection_id)
+    if error:
+        return error
+    
+    book_ids = _book_ids_from_request()
+    if book_ids is None:
+        return jsonify({'success': False, 'message': f"Передайте от 1 до {app.config['COLLECTION_BULK_MAX']} id книг в book_ids"})
+    
+    try:
+        added = Collection.add_books(collection_id, book_ids)
+        recommendations.mark_dirty(*book_ids)
+        db.session.commit()
+        return jsonify({'success': True, 'message': f'Добавлено книг: {added}', 'added': added})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Ошибка при добавлении книг'})
+
+@app.route('/collections/<int:collection_id>/remove_books', methods=['POST'])
+@login_required
+def remove_books_from_collection(collection_id):
+    error = _own_collection_or_error(collection_id)
+    if error:
+        return error
+    
+    book_ids = _book_ids_from_request()
+    if book_ids is None:
+        return jsonify({'success': False, 'message': f"Передайте от 1 до {app.config['COLLECTION_BULK_MAX']} id книг в book_ids"})
+    
+    try:
+        removed = Collection.remove_books(collection_id, book_ids)
+        recommendations.mark_dirty(*book_ids)
+        db.session.commit()
+        return jsonify({'success': True, 'message': f'Удалено книг: {removed}', 'removed': removed})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'message': 'Ошибка при удалении книг'})
+
 if __name__ == '__main__':
-    init_db()
-    app.run(debug=True)
\ No newline at end of file
+    prepare_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from flask import request, send_file
+from werkzeug.security import safe_join
+import http_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Статические файлы с хэшем содержимого в имени: сборка копирует css/js в
+# ASSETS_FOLDER под именами вида style.3f2a9c1b7d4e.css, рядом кладёт сжатые
+# варианты .gz и .br и пишет манифест. url_for('static', ...) подставляет имя из
+# манифеста, а такие файлы отдаются с неизменяемым кэшем и готовым сжатием.
+# Без сборки (манифеста нет) всё работает как обычная статика Flask.
+
+COMPRESSIBLE = {'text/css', 'text/javascript', 'application/javascript', 'application/json',
+                'image/svg+xml', 'text/plain'}
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+MANIFEST = 'manifest.json'
+
+
+def _hashed_name(path, digest):
+    stem, ext = os.path.splitext(path)
+    return f'{stem}.{digest[:12]}{ext}'
+
+
+def _compress(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    written = []
+    for suffix, compressed in variants:
+        # Сжатый вариант без выигрыша только лишний раз читался бы с диска
+        if len(compressed) < len(data):
+            with open(path + suffix, 'wb') as f:
+                f.write(compressed)
+            written.append(suffix)
+    return written
+
+
+def build_assets(static_folder, output_folder, skip=(), report=None):
+    # Каталог сборки пересоздаётся целиком: старые версии файлов в нём не нужны,
+    # клиенты с закэшированными старыми страницами получат их из своего кэша
+    output_folder = os.path.abspath(output_folder)
+    skip = {os.path.abspath(p) for p in skip} | {output_folder}
+    shutil.rmtree(output_folder, ignore_errors=True)
+    if brotli is None and report:
+        report('Модуль brotli не установлен, собираются только варианты .gz')
+    manifest = {}
+    prefix = os.path.relpath(output_folder, static_folder).replace(os.sep, '/')
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) not in skip)
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            logical = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            hashed = _hashed_name(logical, digest)
+            target = os.path.join(output_folder, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+            suffixes = []
+            if mimetypes.guess_type(name)[0] in COMPRESSIBLE:
+                suffixes = _compress(target)
+            manifest[logical] = f'{prefix}/{hashed}'
+            if report:
+                report(f'{logical} -> {manifest[logical]} {" ".join(suffixes)}'.rstrip())
+    with open(os.path.join(output_folder, MANIFEST), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets:
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.hashed = set()
+        self.static_folder = None
+        self._send_plain = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.load(app.config['ASSETS_FOLDER'])
+        app.url_defaults(self._rewrite_url)
+        # Обычный обработчик статики остаётся для файлов вне манифеста
+        self._send_plain = app.view_functions['static']
+        app.view_functions['static'] = self.send_static
+
+    def load(self, output_folder):
+        path = os.path.join(output_folder, MANIFEST)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {}
+        self.hashed = set(self.manifest.values())
+
+    def _rewrite_url(self, endpoint, values):
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    def send_static(self, filename):
+        if filename not in self.hashed:
+            return self._send_plain(filename=filename)
+        path = safe_join(self.static_folder, filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        encoding = None
+        for name, suffix in ENCODINGS:
+            if request.accept_encodings[name] and os.path.exists(path + suffix):
+                encoding, path = name, path + suffix
+                break
+        # send_file отдаёт открытый файл через wsgi.file_wrapper: сервер (gunicorn,
+        # uWSGI) передаёт его через sendfile без копирования в процесс Python,
+        # а с USE_X_SENDFILE отдачу берёт на себя nginx/Apache
+        response = send_file(path, mimetype=mimetype, max_age=http_cache.COVER_MAX_AGE)
+        response.vary.add('Accept-Encoding')
+        if encoding:
+            response.content_encoding = encoding
+        return http_cache.immutable(response)
+
+
+static_assets = Assets()
@@ -0,0 +1,369 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+# Нагрузочный прогон маршрутов на детерминированной синтетической библиотеке.
+# Создаёт временную SQLite-базу, заполняет её пачками через Core, прогоняет
+# маршруты через тестовый клиент Flask и сравнивает результат с сохранённым эталоном.
+#
+#   python benchmark.py --books 20000 --reviews 100000 --output bench.json
+#   python benchmark.py --baseline bench.json --threshold 0.25
+
+BENCH_PASSWORD = 'bench-password'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк маршрутов электронной библиотеки')
+    parser.add_argument('--books', type=int, default=5000)
+    parser.add_argument('--genres', type=int, default=20)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--reviews', type=int, default=20000)
+    parser.add_argument('--collections', type=int, default=500)
+    parser.add_argument('--books-per-collection', type=int, default=20)
+    parser.add_argument('--covers', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--iterations', type=int, default=50, help='Запросов на маршрут')
+    parser.add_argument('--cache', action='store_true', help='Не отключать кэш фрагментов страниц')
+    parser.add_argument('--output', help='Куда сохранить результаты в JSON')
+    parser.add_argument('--baseline', help='Эталон для сравнения; при регрессии код выхода 1')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Допустимый относительный рост p50 (0.25 = +25%%)')
+    parser.add_argument('--noise-ms', type=float, default=2.0,
+                        help='Рост p50 меньше этого числа миллисекунд считается шумом')
+    parser.add_argument('--login-threads', type=int, default=0,
+                        help='Потоков для замера пропускной способности входа (0 — не замерять)')
+    parser.add_argument('--login-duration', type=float, default=5.0, help='Длительность замера входа, секунды')
+    parser.add_argument('--keep-db', action='store_true', help='Не удалять временную базу')
+    return parser.parse_args(argv)
+
+
+def _chunks(rows, size=5000):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def seed(opts, upload_folder):
+    from PIL import Image
+    from werkzeug.security import generate_password_hash
+    import search
+    from models import db, Role, User, Genre, Book, Review, Collection, Cover, \
+        book_genres, book_collections
+
+    rnd = random.Random(opts.seed)
+    insert = lambda model, rows: [db.session.execute(db.insert(model), chunk) for chunk in _chunks(rows)]
+
+    existing = {g.name for g in Genre.query}
+    insert(Genre, [{'name': f'Жанр {i}'} for i in range(opts.genres) if f'Жанр {i}' not in existing])
+    genre_ids = [g.id for g in Genre.query]
+
+    user_role = Role.query.filter_by(name='Пользователь').first()
+    password_hash = generate_password_hash(BENCH_PASSWORD)
+    insert(User, [{'login': f'bench{i}', 'password_hash': password_hash, 'last_name': 'Тестов',
+                   'first_name': f'Читатель{i}', 'role_id': user_role.id} for i in range(opts.users)])
+    user_ids = [u for (u,) in db.session.execute(db.select(User.id).where(User.login.like('bench%')))]
+
+    now = datetime(2024, 1, 1)
+    words = ['мир', 'война', 'дом', 'море', 'город', 'ночь', 'сад', 'путь', 'тайна', 'звезда']
+    insert(Book, [{
+        'title': f'{rnd.choice(words).capitalize()} {rnd.choice(words)} {i}',
+        'description': ' '.join(rnd.choice(words) for _ in range(60)),
+        'year': rnd.randint(1800, 2024),
+        'publisher': f'Издательство {rnd.randint(1, 50)}',
+        'author': f'Автор {rnd.randint(1, opts.books // 10 + 1)}',
+        'pages': rnd.randint(50, 1200),
+        'reviews_count': 0, 'rating_sum': 0, 'updated_at': now,
+    } for i in range(opts.books)])
+    book_ids = [b for (b,) in db.session.execute(db.select(Book.id).order_by(Book.id))]
+
+    insert(book_genres, [{'book_id': b, 'genre_id': g} for b in book_ids
+                         for g in rnd.sample(genre_ids, rnd.randint(1, 3))])
+
+    # Популярность книг неравномерна: часть книг собирает большинство рецензий
+    pairs = set()
+    while len(pairs) < min(opts.reviews, len(book_ids) * len(user_ids)):
+        book = book_ids[min(int(rnd.paretovariate(1.2)) - 1, len(book_ids) - 1)] \
+            if rnd.random() < 0.5 else rnd.choice(book_ids)
+        pairs.add((book, rnd.choice(user_ids)))
+    insert(Review, [{'book_id': b, 'user_id': u, 'rating': rnd.randint(0, 5),
+                     'text': ' '.join(rnd.choice(words) for _ in range(30)),
+                     'created_at': now - timedelta(seconds=rnd.randint(0, 10 ** 8))}
+                    for b, u in sorted(pairs)])
+    # Готовый HTML и выжимки — тем же пакетным пересчётом, что и команда render-texts
+    Book.render_descriptions()
+    Review.render_texts()
+
+    insert(Collection, [{'name': f'Подборка {i}', 'user_id': rnd.choice(user_ids)}
+                        for i in range(opts.collections)])
+    collection_ids = [c for (c,) in db.session.execute(db.select(Collection.id))]
+    insert(book_collections, [{'book_id': b, 'collection_id': c} for c in collection_ids
+                              for b in rnd.sample(book_ids, min(opts.books_per_collection, len(book_ids)))])
+
+    os.makedirs(upload_folder, exist_ok=True)
+    images = []
+    for i in range(5):
+        buffer = io.BytesIO()
+        Image.new('RGB', (600, 900), (40 * i, 90, 160)).save(buffer, 'JPEG')
+        content = buffer.getvalue()
+        md5_hash = hashlib.md5(content).hexdigest()
+        filename = f'{md5_hash}.jpg'
+        with open(os.path.join(upload_folder, filename), 'wb') as f:
+            f.write(content)
+        images.append((filename, md5_hash))
+    insert(Cover, [{'filename': images[i % 5][0], 'md5_hash': images[i % 5][1],
+                    'mime_type': 'image/jpeg', 'book_id': b}
+                   for i, b in enumerate(book_ids[:opts.covers])])
+
+    Book.recompute_review_stats()
+    search.reindex_all()
+    db.session.commit()
+    return book_ids, collection_ids
+
+
+def _login(client, login, password):
+    response = client.post('/login', data={'login': login, 'password': password})
+    if response.status_code != 302:
+        raise RuntimeError(f'Не удалось войти как {login}')
+    return client
+
+
+def build_scenarios(app, book_ids, opts):
+    from models import db, Collection, User
+
+    rnd = random.Random(opts.seed + 1)
+    anon = app.test_client()
+    moderator = _login(app.test_client(), 'moderator', 'moderator123')
+    reader = _login(app.test_client(), 'bench0', BENCH_PASSWORD)
+    with app.app_context():
+        bench_user = db.session.scalar(db.select(User).where(User.login == 'bench0'))
+        collection = db.session.scalar(db.select(Collection).where(Collection.user_id == bench_user.id))
+        if collection is None:
+            collection = Collection(name='Подборка для бенчмарка', user_id=bench_user.id)
+            db.session.add(collection)
+            db.session.commit()
+        collection_id = collection.id
+    batch_ids = ','.join(str(b) for b in rnd.sample(book_ids, min(100, len(book_ids))))
+    counter = iter(range(10 ** 9))
+
+    def fresh_login():
+        client = app.test_client()
+        return client.post('/login', data={'login': f'bench{rnd.randrange(opts.users)}',
+                                           'password': BENCH_PASSWORD})
+
+    # (имя, функция запроса, ожидаемые коды, число итераций)
+    return [
+        ('index', lambda: anon.get('/'), (200,), opts.iterations),
+        ('index_deep_page', lambda: anon.get(f'/?page={max(len(book_ids) // 20, 1)}'), (200,), opts.iterations),
+        ('book_detail', lambda: anon.get(f'/book/{rnd.choice(book_ids)}'), (200,), opts.iterations),
+        ('book_detail_reader', lambda: reader.get(f'/book/{rnd.choice(book_ids)}'), (200,), opts.iterations),
+        ('search', lambda: anon.get('/search?q=мир+дом'), (200,), opts.iterations),
+        ('api_books', lambda: anon.get('/api/books?include=genres,covers,reviews'), (200,), opts.iterations),
+        ('api_books_batch', lambda: anon.get(f'/api/books?ids={batch_ids}&include=genres,reviews'),
+         (200,), opts.iterations),
+        ('moderation_reviews', lambda: moderator.get('/moderation/reviews'), (200,), opts.iterations),
+        ('collections', lambda: reader.get('/collections'), (200,), opts.iterations),
+        ('collection_detail', lambda: reader.get(f'/collections/{collection_id}'), (200,), opts.iterations),
+        ('login', fresh_login, (302,), max(opts.iterations // 10, 3)),
+        ('collections_add', lambda: reader.post('/collections/add', json={'name': f'Новая {next(counter)}'}),
+         (200,), opts.iterations),
+        ('collection_add_book', lambda: reader.post(f'/collections/{collection_id}/add_book',
+                                                    json={'book_id': rnd.choice(book_ids)}),
+         (200,), opts.iterations),
+    ]
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))
+    return values[index]
+
+
+def measure(scenarios, engine):
+    from sqlalchemy import event
+
+    statements = [0]
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_statement(*args):
+        statements[0] += 1
+
+    results = {}
+    for name, request, expected, iterations in scenarios:
+        for _ in range(2):
+            request()
+        timings, queries = [], []
+        for _ in range(iterations):
+            statements[0] = 0
+            started = time.perf_counter()
+            response = request()
+            timings.append((time.perf_counter() - started) * 1000)
+            queries.append(statements[0])
+            if response.status_code not in expected:
+                raise RuntimeError(f'{name}: неожиданный ответ {response.status_code}')
+        # Пиковую память меряем отдельно: tracemalloc сам замедляет запросы
+        tracemalloc.start()
+        for _ in range(3):
+            tracemalloc.reset_peak()
+            request()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results[name] = {
+            'p50_ms': round(statistics.median(timings), 3),
+            'p90_ms': round(_percentile(timings, 90), 3),
+            'p99_ms': round(_percentile(timings, 99), 3),
+            'max_ms': round(max(timings), 3),
+            'queries_avg': round(statistics.mean(queries), 2),
+            'queries_max': max(queries),
+            'peak_memory_kb': round(peak / 1024, 1),
+        }
+    event.remove(engine, 'before_cursor_execute', count_statement)
+    return results
+
+
+def login_throughput(app, opts):
+    # Параллельные входы разных пользователей; каждый вход — новый клиент без сессии
+    deadline = time.perf_counter() + opts.login_duration
+    totals = {'ok': 0, 'rejected': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def worker(number):
+        rnd = random.Random(opts.seed + number)
+        counts = {'ok': 0, 'rejected': 0, 'failed': 0}
+        while time.perf_counter() < deadline:
+            response = app.test_client().post('/login', data={
+                'login': f'bench{rnd.randrange(opts.users)}', 'password': BENCH_PASSWORD})
+            if response.status_code == 302:
+                counts['ok'] += 1
+            elif response.status_code in (429, 503):
+                counts['rejected'] += 1
+            else:
+                counts['failed'] += 1
+        with lock:
+            for key, value in counts.items():
+                totals[key] += value
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(opts.login_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    return {
+        'threads': opts.login_threads,
+        'hash_method': app.config['PASSWORD_HASH_METHOD'],
+        'password_workers': app.config['PASSWORD_WORKERS'],
+        'cores': cores,
+        'logins': totals['ok'],
+        'rejected': totals['rejected'],
+        'failed': totals['failed'],
+        'logins_per_sec': round(totals['ok'] / elapsed, 2),
+        'logins_per_sec_per_core': round(totals['ok'] / elapsed / cores, 2),
+    }
+
+
+def compare(results, baseline, threshold, noise_ms):
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('routes', {}).get(name)
+        if not previous:
+            continue
+        limit = max(previous['p50_ms'] * (1 + threshold), previous['p50_ms'] + noise_ms)
+        if current['p50_ms'] > limit:
+            regressions.append(f"{name}: p50 {current['p50_ms']} мс > {limit:.3f} мс")
+        if current['queries_max'] > previous['queries_max']:
+            regressions.append(f"{name}: SQL-запросов {current['queries_max']} > {previous['queries_max']}")
+    return regressions
+
+
+def compare_logins(current, previous, threshold):
+    if not current or not previous:
+        return []
+    limit = previous['logins_per_sec_per_core'] * (1 - threshold)
+    if current['logins_per_sec_per_core'] < limit:
+        return [f"вход: {current['logins_per_sec_per_core']} входов/с на ядро < {limit:.2f}"]
+    return []
+
+
+def run(opts, workdir):
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['COVER_WORKERS'] = '0'
+    if not opts.cache:
+        os.environ['PAGE_CACHE_BACKEND'] = 'none'
+
+    import app as library
+    from models import db
+
+    app = library.app
+    app.config.update(TESTING=True, WTF_CSRF_ENABLED=False,
+                      UPLOAD_FOLDER=os.path.join(workdir, 'covers'))
+    library.init_db()
+
+    # Запросы идут вне контекста приложения: иначе g (и current_user) общий для всех клиентов
+    with app.app_context():
+        started = time.perf_counter()
+        book_ids, _ = seed(opts, app.config['UPLOAD_FOLDER'])
+        print(f'Данные созданы за {time.perf_counter() - started:.1f} с в {workdir}')
+        engine = db.engine
+    results = measure(build_scenarios(app, book_ids, opts), engine)
+    logins = login_throughput(app, opts) if opts.login_threads else None
+    return results, logins
+
+
+def main(argv=None):
+    opts = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix='library-bench-')
+    try:
+        results, logins = run(opts, workdir)
+    finally:
+        if not opts.keep_db:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"{'маршрут':<22}{'p50':>9}{'p90':>9}{'p99':>9}{'SQL':>7}{'память, КБ':>12}")
+    for name, r in results.items():
+        print(f"{name:<22}{r['p50_ms']:>9}{r['p90_ms']:>9}{r['p99_ms']:>9}"
+              f"{r['queries_max']:>7}{r['peak_memory_kb']:>12}")
+    if logins:
+        print(f"Вход ({logins['threads']} потоков, {logins['hash_method']}): {logins['logins_per_sec']} входов/с, "
+              f"{logins['logins_per_sec_per_core']} на ядро из {logins['cores']}, отклонено {logins['rejected']}")
+
+    report = {
+        'created_at': datetime.utcnow().isoformat(),
+        'dataset': {k: getattr(opts, k) for k in ('books', 'genres', 'users', 'reviews', 'collections',
+                                                  'books_per_collection', 'covers', 'seed')},
+        'routes': results,
+        'logins': logins,
+    }
+    if opts.output:
+        with open(opts.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if opts.baseline:
+        with open(opts.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('dataset') != report['dataset']:
+            print('Внимание: эталон снят на другом наборе данных')
+        regressions = compare(results, baseline, opts.threshold, opts.noise_ms)
+        regressions += compare_logins(logins, baseline.get('logins'), opts.threshold)
+        if regressions:
+            print('Регрессии производительности:')
+            for line in regressions:
+                print(' -', line)
+            return 1
+        print('Регрессий не обнаружено')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,5 +6,60 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'library.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Реплика для чтения: URI другой базы или 'local' — второй файл SQLite рядом с основным
+    DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+    # Сколько секунд после записи пользователь читает с основной базы
+    REPLICA_STICKY_SECONDS = 5
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+    SQLITE_WAL = os.environ.get('SQLITE_WAL', '1') == '1'
+    SQLITE_BUSY_TIMEOUT = 5000  # мс
+    SQLITE_CACHE_KB = 20000
+    SQLITE_MMAP_BYTES = 256 * 1024 * 1024
     UPLOAD_FOLDER = os.path.join(basedir, 'static/covers')
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB
\ No newline at end of file
+    # Куда flask build-assets кладёт css/js с хэшем в имени и сжатыми вариантами; должен быть внутри static
+    ASSETS_FOLDER = os.path.join(basedir, 'static/dist')
+    # flask serve: адрес и число воркеров gunicorn (по умолчанию 2 * ядра + 1)
+    SERVE_BIND = os.environ.get('SERVE_BIND', '127.0.0.1:8000')
+    SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', 2 * (os.cpu_count() or 1) + 1))
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB
+    # Ширины миниатюр обложек и размер пула фоновой обработки (0 — синхронно)
+    COVER_SIZES = (160, 320, 640)
+    COVER_WORKERS = int(os.environ.get('COVER_WORKERS', 2))
+    # Кэш фрагментов страниц: 'memory' (LRU в процессе), 'sqlite' (общий для воркеров) или 'none'
+    PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+    PAGE_CACHE_MAX_ENTRIES = 2048
+    PAGE_CACHE_TTL = 600
+    PAGE_CACHE_PATH = os.path.join(basedir, 'instance', 'page_cache.db')
+    # Время жизни кэша пользователей и ролей, секунды
+    IDENTITY_CACHE_TTL = 60
+    # Сколько книг можно добавить или убрать из подборки одним запросом
+    COLLECTION_BULK_MAX = 1000
+    # Сколько рецензий модератор может удалить или одобрить одним действием
+    MODERATION_BULK_MAX = 500
+    # Алгоритм и стоимость хэша паролей в формате werkzeug ('pbkdf2:sha256:600000', 'scrypt:32768:8:1');
+    # хэши с другими параметрами пересчитываются при следующем входе
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+    # Потоки для проверки паролей (0 — в потоке запроса) и сколько проверок может ждать в очереди
+    PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 1))
+    PASSWORD_MAX_PENDING = 16
+    PASSWORD_VERIFY_TIMEOUT = 10
+    # Ограничение неудачных попыток входа на логин и на IP за окно LOGIN_THROTTLE_WINDOW секунд.
+    # Счётчики хранятся в памяти каждого воркера: под flask serve с N воркерами
+    # фактический предел до N * LOGIN_MAX_FAILURES (и N * LOGIN_MAX_FAILURES_PER_IP)
+    LOGIN_THROTTLE_WINDOW = 300
+    LOGIN_MAX_FAILURES = 5
+    LOGIN_MAX_FAILURES_PER_IP = 50
+    # Просмотры книг копятся в памяти воркера и пишутся в базу пачкой раз в столько секунд (0 — сразу)
+    VIEW_FLUSH_INTERVAL = int(os.environ.get('VIEW_FLUSH_INTERVAL', 10))
+    # Списки лидеров на главной: окно «популярное за последние дни», длина списков
+    # и как часто они перестраиваются, секунды
+    POPULAR_WINDOW_DAYS = 7
+    POPULAR_LIMIT = 10
+    POPULAR_REFRESH_SECONDS = 300
+    # Метрики запросов (/metrics) и отладочные заголовки Server-Timing / X-SQL-Queries
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+    METRICS_DEBUG_HEADER = os.environ.get('METRICS_DEBUG_HEADER') == '1'
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_N_PLUS_ONE_THRESHOLD = 5
+    METRICS_SLOW_QUERY_MS = 100
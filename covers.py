@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import current_app
+from PIL import Image
+from werkzeug.utils import secure_filename
+from models import db, Book, Cover, CoverVariant, ChangeMarker
+from page_cache import page_cache
+
+# Конвейер обложек: потоковое сохранение загрузки с подсчётом md5,
+# дедупликация по хэшу и фоновая генерация миниатюр (WebP и JPEG)
+
+CHUNK_SIZE = 64 * 1024
+VARIANT_FORMATS = (
+    ('WEBP', 'webp', 'image/webp', {'quality': 80, 'method': 4}),
+    ('JPEG', 'jpg', 'image/jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+)
+
+_executor = None
+_executor_lock = threading.Lock()
+_slots = None
+
+
+def _get_executor(app):
+    global _executor, _slots
+    with _executor_lock:
+        if _executor is None:
+            workers = app.config['COVER_WORKERS']
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='covers')
+            # Ограничиваем очередь: при переполнении задача выполняется в текущем потоке
+            _slots = threading.BoundedSemaphore(workers * 4)
+    return _executor
+
+
+def _stream_to_disk(file, folder):
+    # Пишем загрузку во временный файл кусками, одновременно считая md5
+    os.makedirs(folder, exist_ok=True)
+    tmp_path = os.path.join(folder, f'.upload-{uuid.uuid4().hex}')
+    md5 = hashlib.md5()
+    with open(tmp_path, 'wb') as f:
+        while True:
+            chunk = file.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            md5.update(chunk)
+            f.write(chunk)
+    return tmp_path, md5.hexdigest()
+
+
+def store_upload(file, book_id):
+    folder = current_app.config['UPLOAD_FOLDER']
+    tmp_path, md5_hash = _stream_to_disk(file, folder)
+
+    existing_cover = Cover.query.filter_by(md5_hash=md5_hash).first()
+    if existing_cover:
+        # Файл уже есть на диске: привязываем его к этой книге без повторной записи
+        os.remove(tmp_path)
+        cover = Cover(
+            filename=existing_cover.filename,
+            mime_type=existing_cover.mime_type,
+            md5_hash=md5_hash,
+            book_id=book_id
+        )
+        db.session.add(cover)
+        db.session.flush()
+        return cover
+
+    cover = Cover(
+        filename=secure_filename(file.filename),
+        mime_type=file.mimetype,
+        md5_hash=md5_hash,
+        book_id=book_id
+    )
+    db.session.add(cover)
+    db.session.flush()
+
+    filename = f"{cover.id}.{file.filename.rsplit('.', 1)[1].lower()}"
+    os.replace(tmp_path, os.path.join(folder, filename))
+    cover.filename = filename
+    return cover
+
+
+def build_variants(md5_hash, filename):
+    folder = current_app.config['UPLOAD_FOLDER']
+    sizes = current_app.config['COVER_SIZES']
+    existing = {v.filename for v in CoverVariant.query.filter_by(md5_hash=md5_hash)}
+    if all(f'{md5_hash}_{width}.{ext}' in existing
+           for width in sizes for _, ext, _, _ in VARIANT_FORMATS):
+        return False
+
+    with Image.open(os.path.join(folder, filename)) as source:
+        # Для JPEG декодируем сразу в уменьшенном масштабе
+        source.draft('RGB', (max(sizes), source.height * max(sizes) // source.width))
+        image = source.convert('RGB')
+
+    added = False
+    for width in sizes:
+        # Не увеличиваем маленькие изображения, но самый мелкий вариант делаем всегда
+        if width > image.width and width != min(sizes):
+            continue
+        if width < image.width:
+            resized = image.resize((width, max(1, image.height * width // image.width)), Image.LANCZOS)
+        else:
+            resized = image
+        for pil_format, ext, mime_type, options in VARIANT_FORMATS:
+            variant_name = f'{md5_hash}_{width}.{ext}'
+            if variant_name in existing:
+                continue
+            resized.save(os.path.join(folder, variant_name), pil_format, **options)
+            db.session.add(CoverVariant(
+                md5_hash=md5_hash,
+                width=resized.width,
+                height=resized.height,
+                format=ext,
+                filename=variant_name,
+                mime_type=mime_type
+            ))
+            added = True
+    if added:
+        # ETag страниц книг и API строится по updated_at: без этого клиент получит 304
+        # и останется с HTML без srcset
+        db.session.execute(
+            db.update(Book)
+            .where(Book.id.in_(db.select(Cover.book_id).where(Cover.md5_hash == md5_hash)))
+            .values(updated_at=datetime.utcnow()))
+        ChangeMarker.touch(ChangeMarker.CATALOGUE)
+    db.session.commit()
+    return added
+
+
+def _build_variants_task(app, md5_hash, filename):
+    with app.app_context():
+        try:
+            if build_variants(md5_hash, filename):
+                # Закэшированные страницы книг должны получить srcset
+                for (book_id,) in db.session.query(Cover.book_id).filter_by(md5_hash=md5_hash):
+                    page_cache.invalidate_book(book_id)
+        except Exception:
+            db.session.rollback()
+            app.logger.exception('Не удалось построить миниатюры обложки %s', md5_hash)
+
+
+def schedule_variants(cover):
+    # Вызывается после коммита, когда файл обложки уже на месте
+    app = current_app._get_current_object()
+    args = (app, cover.md5_hash, cover.filename)
+    if not app.config['COVER_WORKERS']:
+        _build_variants_task(*args)
+        return
+    executor = _get_executor(app)
+    if not _slots.acquire(blocking=False):
+        _build_variants_task(*args)
+        return
+    future = executor.submit(_build_variants_task, *args)
+    future.add_done_callback(lambda _: _slots.release())
+
+
+def delete_cover_files(cover):
+    # Файлы общие для всех обложек с тем же md5, удаляем их только вместе с последней
+    shared = Cover.query.filter(Cover.md5_hash == cover.md5_hash,
+                                Cover.book_id != cover.book_id).count()
+    if shared:
+        return
+    folder = current_app.config['UPLOAD_FOLDER']
+    filenames = [cover.filename] + [v.filename for v in cover.variants]
+    for filename in filenames:
+        file_path = os.path.join(folder, filename)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    CoverVariant.query.filter_by(md5_hash=cover.md5_hash).delete()
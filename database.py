@@ -0,0 +1,120 @@
+import functools
+import sqlite3
+import time
+from flask import g, has_app_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+
+# Профили движков и маршрутизация чтения. SQLite работает в WAL с таймаутом
+# ожидания блокировки, MySQL — с пулом и pre-ping. Если задан DATABASE_REPLICA_URL,
+# представления с декоратором read_only читают с реплики; запись и всё остальное
+# идут в основную базу. После записи пользователь какое-то время читает с основной
+# базы, чтобы видеть свои изменения несмотря на отставание реплики.
+
+REPLICA = 'replica'
+_sqlite_settings = {'busy_timeout': 5000, 'wal': True, 'cache_kb': 20000, 'mmap_bytes': 256 * 1024 * 1024}
+
+
+def engine_options(uri, config):
+    url = make_url(uri)
+    if url.get_backend_name() == 'sqlite':
+        options = {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000}}
+        # Для базы в памяти Flask-SQLAlchemy ставит StaticPool, у которого нет размера
+        if url.database and url.database != ':memory:':
+            options.update(pool_size=config['DB_POOL_SIZE'], max_overflow=config['DB_MAX_OVERFLOW'])
+        return options
+    if url.get_backend_name() == 'mysql':
+        return {
+            'pool_size': config['DB_POOL_SIZE'],
+            'max_overflow': config['DB_MAX_OVERFLOW'],
+            'pool_timeout': 10,
+            # MySQL закрывает простаивающие соединения через wait_timeout
+            'pool_recycle': 280,
+            'pool_pre_ping': True,
+        }
+    return {}
+
+
+def replica_uri(config):
+    uri = config['DATABASE_REPLICA_URL']
+    if uri == 'local':
+        # Локальный режим для проверки маршрутизации: копия файла SQLite рядом с основным
+        url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+        if url.get_backend_name() != 'sqlite' or not url.database:
+            raise ValueError('Локальная реплика доступна только для файловой SQLite')
+        stem, dot, ext = url.database.rpartition('.')
+        return str(url.set(database=f'{stem}-replica.{ext}' if dot else f'{url.database}-replica'))
+    return uri
+
+
+def configure(app):
+    # Вызывается до db.init_app: движки создаются из этих настроек
+    config = app.config
+    _sqlite_settings.update(busy_timeout=config['SQLITE_BUSY_TIMEOUT'], wal=config['SQLITE_WAL'],
+                            cache_kb=config['SQLITE_CACHE_KB'], mmap_bytes=config['SQLITE_MMAP_BYTES'])
+    config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(config['SQLALCHEMY_DATABASE_URI'], config))
+    if config['DATABASE_REPLICA_URL']:
+        uri = replica_uri(config)
+        config.setdefault('SQLALCHEMY_BINDS', {})[REPLICA] = dict(engine_options(uri, config), url=uri)
+
+    @app.after_request
+    def remember_write(response):
+        from models import db
+        if REPLICA in db.engines and db.session.registry.has() and db.session.info.pop('wrote', False):
+            flask_session['primary_until'] = time.time() + config['REPLICA_STICKY_SECONDS']
+        return response
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('read_replica'):
+            return self._db.engines[REPLICA]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_write(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _mark_bulk_write(state):
+    # Массовые INSERT/UPDATE/DELETE через session.execute проходят мимо flush
+    if state.is_insert or state.is_update or state.is_delete:
+        state.session.info['wrote'] = True
+
+
+def read_only(view):
+    # Флаг хранится в g, а не в локальной переменной: потоковые ответы
+    # (stream_with_context) читают базу уже после возврата из представления
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        from models import db
+        if REPLICA in db.engines and flask_session.get('primary_until', 0) < time.time():
+            g.read_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    settings = _sqlite_settings
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout={int(settings['busy_timeout'])}")
+    if settings['wal']:
+        # Читатели не блокируются писателем; synchronous=NORMAL безопасен в режиме WAL
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA cache_size=-{int(settings['cache_kb'])}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings['mmap_bytes'])}")
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
+def sync_replica(primary_engine, replica_engine):
+    # Копирует основную SQLite-базу в файл локальной реплики через backup API
+    with primary_engine.connect() as source, replica_engine.connect() as target:
+        source.connection.driver_connection.backup(target.connection.driver_connection)
@@ -0,0 +1,104 @@
+import csv
+import io
+import json
+from datetime import datetime
+from models import db, Book, Genre, Review, Collection, book_genres, book_collections
+
+# Потоковая выгрузка каталога, рецензий и состава подборок.
+# Строки читаются серверным курсором пачками по YIELD_PER и сразу
+# сериализуются, поэтому память не зависит от объёма таблиц.
+
+YIELD_PER = 1000
+
+BOOK_FIELDS = ('id', 'title', 'author', 'publisher', 'year', 'pages', 'genres',
+               'reviews_count', 'avg_rating', 'updated_at')
+REVIEW_FIELDS = ('id', 'book_id', 'user_id', 'rating', 'text', 'created_at')
+COLLECTION_FIELDS = ('collection_id', 'collection_name', 'user_id', 'book_id')
+
+
+def _stream(stmt):
+    for row in db.session.execute(stmt.execution_options(yield_per=YIELD_PER)):
+        yield row._asdict()
+
+
+def iter_books(since_id=None):
+    genres = db.select(db.func.aggregate_strings(Genre.name, ';')) \
+        .select_from(book_genres).join(Genre, Genre.id == book_genres.c.genre_id) \
+        .where(book_genres.c.book_id == Book.id).scalar_subquery()
+    stmt = db.select(Book.id, Book.title, Book.author, Book.publisher, Book.year, Book.pages,
+                     genres.label('genres'), Book.reviews_count, Book.rating_sum, Book.updated_at) \
+        .order_by(Book.id)
+    if since_id:
+        stmt = stmt.where(Book.id > since_id)
+    for row in _stream(stmt):
+        rating_sum = row.pop('rating_sum')
+        row['avg_rating'] = round(rating_sum / row['reviews_count'], 2) if row['reviews_count'] else 0
+        row['genres'] = row['genres'] or ''
+        yield row
+
+
+def iter_reviews(since=None):
+    stmt = db.select(Review.id, Review.book_id, Review.user_id, Review.rating, Review.text,
+                     Review.created_at).order_by(Review.created_at, Review.id)
+    if since:
+        stmt = stmt.where(Review.created_at > since)
+    return _stream(stmt)
+
+
+def iter_collections(since_id=None):
+    stmt = db.select(Collection.id.label('collection_id'), Collection.name.label('collection_name'),
+                     Collection.user_id, book_collections.c.book_id) \
+        .join(book_collections, book_collections.c.collection_id == Collection.id) \
+        .order_by(Collection.id, book_collections.c.book_id)
+    if since_id:
+        stmt = stmt.where(Collection.id > since_id)
+    return _stream(stmt)
+
+
+EXPORTS = {
+    'books': (iter_books, BOOK_FIELDS),
+    'reviews': (iter_reviews, REVIEW_FIELDS),
+    'collections': (iter_collections, COLLECTION_FIELDS),
+}
+
+
+def _plain(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def to_csv(rows, fields):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fields)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({k: _plain(v) for k, v in row.items()})
+        # Отдаём накопленное кусками порядка 64 КБ
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def to_jsonl(rows, fields=None):
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps({k: _plain(v) for k, v in row.items()}, ensure_ascii=False))
+        if len(chunk) >= YIELD_PER:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
+
+
+FORMATS = {
+    'csv': (to_csv, 'text/csv'),
+    'jsonl': (to_jsonl, 'application/x-ndjson'),
+}
+
+
+def export(kind, fmt, since=None, since_id=None):
+    iterator, fields = EXPORTS[kind]
+    serializer, _ = FORMATS[fmt]
+    rows = iterator(since=since) if kind == 'reviews' else iterator(since_id=since_id)
+    return serializer(rows, fields)
@@ -0,0 +1,72 @@
+import hashlib
+from datetime import timezone
+from flask import request, session, make_response
+from flask_login import current_user
+
+# Условные GET-запросы: ETag/Last-Modified строятся из отметок времени изменений,
+# поэтому 304 можно ответить до загрузки данных и рендеринга шаблона
+
+COVER_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def make_etag(*parts):
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode()).hexdigest()
+
+
+def _as_utc(value):
+    if value is None:
+        return None
+    return value.replace(tzinfo=timezone.utc, microsecond=0)
+
+
+def _cacheable(shared):
+    # Для HTML-страниц валидаторы выдаём только анонимам: страницы пользователей
+    # зависят от их роли, рецензий и подборок. Ответ с flash-сообщениями одноразовый.
+    # shared=True — ответ не зависит от пользователя (JSON API).
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    return shared or (not current_user.is_authenticated and not session.get('_flashes'))
+
+
+def _cache_control(response, shared):
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    if not shared:
+        response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag, last_modified=None, shared=False):
+    if not _cacheable(shared):
+        return None
+    last_modified = _as_utc(last_modified)
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified:
+        fresh = last_modified <= request.if_modified_since
+    else:
+        fresh = False
+    if not fresh:
+        return None
+    response = make_response('', 304)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return _cache_control(response, shared)
+
+
+def with_validators(body, etag, last_modified=None, shared=False):
+    response = make_response(body)
+    if not _cacheable(shared):
+        return response
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = _as_utc(last_modified)
+    return _cache_control(response, shared)
+
+
+def immutable(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = COVER_MAX_AGE
+    response.cache_control.immutable = True
+    return response
@@ -0,0 +1,86 @@
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, User, Role
+
+# Кэш пользователей (вместе с ролью) и таблица ролей в памяти процесса.
+# Записи живут IDENTITY_CACHE_TTL секунд и сбрасываются после коммита,
+# изменившего пользователя или роль; TTL ограничивает устаревание в других воркерах.
+
+
+class IdentityCache:
+    def __init__(self, app=None):
+        self.ttl = 60
+        self._users = {}
+        self._roles = None
+        self._roles_expire = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+
+    def load_user(self, user_id):
+        now = time.monotonic()
+        entry = self._users.get(user_id)
+        if entry is None or entry[0] < now:
+            user = db.session.get(User, user_id, options=[db.joinedload(User.role)])
+            if user is None:
+                return None
+            # В кэше храним отсоединённую копию, в сессию запроса её добавляет merge
+            db.session.expunge(user)
+            with self._lock:
+                self._users[user_id] = (now + self.ttl, user)
+            entry = self._users[user_id]
+        return db.session.merge(entry[1], load=False)
+
+    def role_names(self):
+        now = time.monotonic()
+        roles = self._roles
+        if roles is None or self._roles_expire < now:
+            roles = dict(db.session.execute(db.select(Role.id, Role.name)).all())
+            with self._lock:
+                self._roles = roles
+                self._roles_expire = now + self.ttl
+        return roles
+
+    def role_name(self, role_id):
+        return self.role_names().get(role_id)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def invalidate_roles(self):
+        with self._lock:
+            self._roles = None
+            self._users.clear()
+
+
+identity_cache = IdentityCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_identity_changes(session, flush_context):
+    changed = session.info.setdefault('identity_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            changed.add(obj.id)
+        elif isinstance(obj, Role):
+            changed.add(Role)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_identity_changes(session):
+    for change in session.info.pop('identity_changes', ()):
+        if change is Role:
+            identity_cache.invalidate_roles()
+        else:
+            identity_cache.invalidate_user(change)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_identity_changes(session):
+    session.info.pop('identity_changes', None)
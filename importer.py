@@ -0,0 +1,205 @@
+import csv
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+import rich_text
+from flask import current_app
+from werkzeug.datastructures import MultiDict
+from forms import BookForm
+from models import db, Book, Genre, Cover, ChangeMarker, book_genres
+import search
+
+# Потоковый импорт каталога из CSV/JSONL: строки читаются по одной,
+# вставка идёт пачками через Core, прогресс сохраняется после каждого коммита
+
+BOOK_FIELDS = ('title', 'description', 'year', 'publisher', 'author', 'pages')
+ALLOWED_COVER_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif'}
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+class MalformedRow:
+    # Строка, которую не удалось разобрать; учитывается как пропущенная, импорт продолжается
+    def __init__(self, message):
+        self.message = message
+
+
+def read_rows(path, fmt=None):
+    fmt = fmt or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+    with open(path, encoding='utf-8', newline='') as f:
+        if fmt == 'jsonl':
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield MalformedRow(f'строка файла {line_number}: некорректный JSON ({e.msg})')
+        else:
+            yield from csv.DictReader(f)
+
+
+def _genre_names(value):
+    if isinstance(value, list):
+        return [str(v).strip() for v in value if str(v).strip()]
+    return [v.strip() for v in (value or '').split(';') if v.strip()]
+
+
+def validate_row(row, genre_ids):
+    if isinstance(row, MalformedRow):
+        return None, {'row': [row.message]}
+    if not isinstance(row, dict):
+        return None, {'row': [f'ожидается JSON-объект, получено {type(row).__name__}']}
+    # Те же ограничения, что и у формы добавления книги
+    names = _genre_names(row.get('genres'))
+    formdata = MultiDict({field: str(row.get(field) or '') for field in BOOK_FIELDS})
+    for name in names:
+        if name in genre_ids:
+            formdata.add('genres', str(genre_ids[name]))
+    form = BookForm(formdata=formdata, meta={'csrf': False})
+    form.genres.choices = [(gid, name) for name, gid in genre_ids.items()]
+    errors = {}
+    if not form.validate():
+        errors.update({field: msgs for field, msgs in form.errors.items() if field != 'cover'})
+    unknown = [name for name in names if name not in genre_ids]
+    if unknown:
+        errors['genres'] = [f'Неизвестные жанры: {", ".join(unknown)}']
+    cover = row.get('cover')
+    if cover:
+        ext = cover.rsplit('.', 1)[-1].lower() if '.' in cover else ''
+        if ext not in ALLOWED_COVER_EXTENSIONS:
+            errors['cover'] = ['Только изображения!']
+    if errors:
+        return None, errors
+    book = {field: form[field].data for field in BOOK_FIELDS}
+    book['description_html'], book['description_excerpt'] = rich_text.prepare(book['description'])
+    return (book, form.genres.data, cover), None
+
+
+def hash_file(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _load_progress(progress_path):
+    if progress_path and os.path.exists(progress_path):
+        with open(progress_path) as f:
+            return json.load(f)
+    return {'rows': 0, 'imported': 0, 'skipped': 0}
+
+
+def _save_progress(progress_path, progress):
+    tmp_path = progress_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(progress, f)
+    os.replace(tmp_path, progress_path)
+
+
+def _insert_books(books):
+    now = datetime.utcnow()
+    rows = [dict(book, reviews_count=0, rating_sum=0, updated_at=now) for book in books]
+    if db.engine.dialect.insert_executemany_returning_sort_by_parameter_order:
+        result = db.session.execute(
+            db.insert(Book).returning(Book.id, sort_by_parameter_order=True), rows)
+        return [row.id for row in result]
+    # MySQL не возвращает id при executemany: вставляем по одной в той же транзакции
+    return [db.session.execute(db.insert(Book), row).inserted_primary_key[0] for row in rows]
+
+
+def _store_covers(batch, book_ids, base_dir, pool):
+    paths = {}
+    for (_, _, cover), book_id in zip(batch, book_ids):
+        if cover:
+            paths[book_id] = cover if os.path.isabs(cover) else os.path.join(base_dir, cover)
+    if not paths:
+        return
+    hashes = dict(zip(paths, pool.map(hash_file, paths.values(), chunksize=16)))
+    existing = dict(db.session.execute(
+        db.select(Cover.md5_hash, db.func.min(Cover.filename))
+        .where(Cover.md5_hash.in_(set(hashes.values())))
+        .group_by(Cover.md5_hash)
+    ).all())
+    folder = current_app.config['UPLOAD_FOLDER']
+    os.makedirs(folder, exist_ok=True)
+    rows = []
+    for book_id, md5_hash in hashes.items():
+        path = paths[book_id]
+        if md5_hash not in existing:
+            # Импортированные обложки именуются по хэшу содержимого
+            filename = f"{md5_hash}.{path.rsplit('.', 1)[1].lower()}"
+            shutil.copyfile(path, os.path.join(folder, filename))
+            existing[md5_hash] = filename
+        rows.append({
+            'filename': existing[md5_hash],
+            'mime_type': mimetypes.guess_type(path)[0] or 'application/octet-stream',
+            'md5_hash': md5_hash,
+            'book_id': book_id,
+        })
+    db.session.execute(db.insert(Cover), rows)
+
+
+def _flush_batch(batch, base_dir, pool):
+    book_ids = _insert_books([book for book, _, _ in batch])
+    links = [{'book_id': book_id, 'genre_id': genre_id}
+             for (_, genres, _), book_id in zip(batch, book_ids) for genre_id in genres]
+    if links:
+        db.session.execute(db.insert(book_genres), links)
+    _store_covers(batch, book_ids, base_dir, pool)
+    search.index_books(db.session.execute(
+        db.select(Book.id, Book.title, Book.author, Book.publisher, Book.description)
+        .where(Book.id.in_(book_ids))
+    ))
+    ChangeMarker.touch(ChangeMarker.CATALOGUE)
+
+
+def import_books(path, fmt=None, batch_size=1000, dry_run=False, restart=False,
+                 workers=None, report=print):
+    progress_path = None if dry_run else path + '.progress'
+    if restart and progress_path and os.path.exists(progress_path):
+        os.remove(progress_path)
+    progress = _load_progress(progress_path)
+    if progress['rows']:
+        report(f"Продолжаем импорт со строки {progress['rows'] + 1}")
+
+    genre_ids = dict(db.session.execute(db.select(Genre.name, Genre.id)).all())
+    base_dir = os.path.dirname(os.path.abspath(path))
+    rows = islice(read_rows(path, fmt), progress['rows'], None)
+    errors_shown = 0
+    batch = []
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for number, row in enumerate(rows, start=progress['rows'] + 1):
+            parsed, errors = validate_row(row, genre_ids)
+            if errors:
+                progress['skipped'] += 1
+                if errors_shown < 20:
+                    report(f'Строка {number}: {errors}')
+                    errors_shown += 1
+            elif not dry_run:
+                batch.append(parsed)
+            progress['rows'] = number
+
+            if len(batch) >= batch_size:
+                _flush_batch(batch, base_dir, pool)
+                progress['imported'] += len(batch)
+                db.session.commit()
+                _save_progress(progress_path, progress)
+                report(f"Импортировано {progress['imported']} книг")
+                batch = []
+
+        if batch:
+            _flush_batch(batch, base_dir, pool)
+            progress['imported'] += len(batch)
+            db.session.commit()
+
+    if progress_path and os.path.exists(progress_path):
+        os.remove(progress_path)
+    return progress
@@ -0,0 +1,247 @@
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from flask import request, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Метрики запросов: число и время SQL-запросов, самые медленные запросы,
+# повторяющиеся запросы (признак N+1), время рендеринга шаблонов и гистограммы
+# длительности ответов. Всё копится в памяти процесса и отдаётся в формате
+# Prometheus; на каждый SQL-запрос приходится пара вызовов time.perf_counter.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+SLOWEST_KEPT = 3
+
+_current = ContextVar('request_metrics', default=None)
+_IN_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)|\((?:\s*%s\s*,)+\s*%s\s*\)|\(__\[POSTCOMPILE_\w+\]\)')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def fingerprint(statement):
+    # Запросы, отличающиеся только литералами и длиной IN (...), считаем одинаковыми
+    statement = _IN_LIST.sub('(?)', statement)
+    return ' '.join(_LITERAL.sub('?', statement).split())
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0, 0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+
+class RequestStats:
+    __slots__ = ('started', 'queries', 'db_time', 'statements', 'slowest', 'render_time', 'render_started')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = {}
+        self.slowest = []
+        self.render_time = 0.0
+        self.render_started = []
+
+    def repeated(self, threshold):
+        # N+1 — это повторяющиеся чтения; пачка однотипных INSERT/UPDATE признаком не считается
+        counts = {}
+        for statement, count in self.statements.items():
+            if not statement.lstrip().upper().startswith('SELECT'):
+                continue
+            key = fingerprint(statement)
+            counts[key] = counts.get(key, 0) + count
+        return {key: count for key, count in counts.items() if count >= threshold}
+
+
+def _labels(**labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ') for _, v in items)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + '}'
+
+
+class Metrics:
+    def __init__(self, app=None):
+        self.enabled = True
+        self.debug_header = False
+        self.n_plus_one_threshold = 5
+        self.slow_query_ms = 100
+        self.logger = None
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.n_plus_one = {}
+        self.slow_queries = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.db_time = Histogram(LATENCY_BUCKETS)
+        self.query_count = Histogram(QUERY_COUNT_BUCKETS)
+        self.render_time = Histogram(LATENCY_BUCKETS)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['METRICS_ENABLED']
+        self.debug_header = app.config['METRICS_DEBUG_HEADER']
+        self.n_plus_one_threshold = app.config['METRICS_N_PLUS_ONE_THRESHOLD']
+        self.slow_query_ms = app.config['METRICS_SLOW_QUERY_MS']
+        self.logger = app.logger
+        if not self.enabled:
+            return
+        # Слушаем класс Engine, чтобы учитывать все движки, включая дополнительные binds
+        if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        app.teardown_request(self._teardown_request)
+
+    def _start_request(self):
+        request._metrics_token = _current.set(RequestStats())
+
+    def _before_render(self, sender, template, context, **extra):
+        stats = _current.get()
+        if stats is not None:
+            stats.render_started.append(time.perf_counter())
+
+    def _after_render(self, sender, template, context, **extra):
+        stats = _current.get()
+        if stats is not None and stats.render_started:
+            elapsed = time.perf_counter() - stats.render_started.pop()
+            # Вложенный render_template уже учтён во внешнем
+            if not stats.render_started:
+                stats.render_time += elapsed
+            with self._lock:
+                self.render_time.observe(_labels(template=template.name or 'string'), elapsed)
+
+    def _finish_request(self, response):
+        stats = _current.get()
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or 'unknown'
+        labels = _labels(endpoint=endpoint)
+        repeated = stats.repeated(self.n_plus_one_threshold) if stats.queries >= self.n_plus_one_threshold else {}
+        with self._lock:
+            key = _labels(endpoint=endpoint, method=request.method, status=response.status_code)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.latency.observe(labels, elapsed)
+            self.db_time.observe(labels, stats.db_time)
+            self.query_count.observe(labels, stats.queries)
+            if repeated:
+                self.n_plus_one[labels] = self.n_plus_one.get(labels, 0) + 1
+        for statement, count in repeated.items():
+            self.logger.warning('Возможный N+1 в %s: %d повторов запроса %s', endpoint, count, statement[:300])
+        if stats.db_time * 1000 >= self.slow_query_ms:
+            self.logger.warning('%s: %d SQL-запросов за %.0f мс, самые долгие: %s', endpoint, stats.queries,
+                                stats.db_time * 1000,
+                                '; '.join(f'{e * 1000:.1f} мс {s[:200]}' for e, s in stats.slowest))
+
+        if self.debug_header:
+            response.headers['Server-Timing'] = (
+                f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+                f'tpl;dur={stats.render_time * 1000:.1f}, app;dur={elapsed * 1000:.1f}')
+            response.headers['X-SQL-Queries'] = str(stats.queries)
+            if repeated:
+                response.headers['X-SQL-Repeated'] = str(max(repeated.values()))
+        return response
+
+    def _teardown_request(self, exc=None):
+        token = getattr(request, '_metrics_token', None)
+        if token is not None:
+            _current.reset(token)
+
+    def record_query(self, stats, statement, elapsed):
+        stats.queries += 1
+        stats.db_time += elapsed
+        stats.statements[statement] = stats.statements.get(statement, 0) + 1
+        slowest = stats.slowest
+        if len(slowest) < SLOWEST_KEPT or elapsed > slowest[-1][0]:
+            slowest.append((elapsed, statement))
+            slowest.sort(key=lambda item: -item[0])
+            del slowest[SLOWEST_KEPT:]
+        if elapsed * 1000 >= self.slow_query_ms:
+            key = fingerprint(statement)
+            with self._lock:
+                self.slow_queries[key] = self.slow_queries.get(key, 0) + 1
+            self.logger.warning('Медленный запрос (%.0f мс): %s', elapsed * 1000, statement[:300])
+
+    def current(self):
+        stats = _current.get()
+        if stats is None:
+            return None
+        return {
+            'queries': stats.queries,
+            'db_ms': round(stats.db_time * 1000, 3),
+            'render_ms': round(stats.render_time * 1000, 3),
+            'slowest': [{'ms': round(elapsed * 1000, 3), 'sql': statement} for elapsed, statement in stats.slowest],
+            'repeated': stats.repeated(self.n_plus_one_threshold),
+        }
+
+    def _render_histogram(self, lines, name, help_text, histogram):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, (counts, total, count) in sorted(histogram.series.items()):
+            cumulative = 0
+            for bound, bucket in zip(histogram.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {total}')
+            lines.append(f'{name}_count{_format_labels(labels)} {count}')
+
+    def _render_counter(self, lines, name, help_text, values):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in sorted(values.items()):
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    def render(self):
+        lines = []
+        with self._lock:
+            self._render_counter(lines, 'library_http_requests_total', 'HTTP requests', self.requests)
+            self._render_histogram(lines, 'library_http_request_duration_seconds', 'Request latency',
+                                   self.latency)
+            self._render_histogram(lines, 'library_db_queries_per_request', 'SQL statements per request',
+                                   self.query_count)
+            self._render_histogram(lines, 'library_db_time_seconds', 'Time spent in SQL per request',
+                                   self.db_time)
+            self._render_histogram(lines, 'library_template_render_seconds', 'Template render time',
+                                   self.render_time)
+            self._render_counter(lines, 'library_n_plus_one_total', 'Requests with repeated SQL statements',
+                                 self.n_plus_one)
+            self._render_counter(lines, 'library_slow_queries_total', 'Statements slower than the threshold',
+                                 {_labels(query=k[:200]): v for k, v in self.slow_queries.items()})
+        return '\n'.join(lines) + '\n'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info['metrics_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    if stats is None:
+        return
+    started = conn.info.pop('metrics_started', None)
+    if started is not None:
+        metrics.record_query(stats, statement, time.perf_counter() - started)
+
+
+metrics = Metrics()
@@ -0,0 +1,128 @@
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+from models import db, Book, Review, SchemaMigration
+import search
+
+# Версионированные миграции схемы. create_all создаёт только недостающие таблицы,
+# поэтому изменения существующих таблиц (колонки, индексы) описываются здесь.
+# Каждая миграция идемпотентна: на базе, созданной create_all с нуля, она ничего
+# не меняет, а только записывается в schema_migrations.
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def decorator(func):
+        MIGRATIONS.append((version, description, func))
+        return func
+    return decorator
+
+
+def _columns(table):
+    return {c['name'] for c in db.inspect(db.engine).get_columns(table)}
+
+
+def add_column(table, name, ddl):
+    if name in _columns(table):
+        return False
+    with db.engine.begin() as conn:
+        conn.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {name} {ddl}'))
+    return True
+
+
+def create_index(table, name):
+    # Описание индекса берётся из моделей, чтобы не дублировать его здесь
+    index = next(i for i in db.metadata.tables[table].indexes if i.name == name)
+    existing = {i['name'] for i in db.inspect(db.engine).get_indexes(table)}
+    if name in existing:
+        return False
+    if db.engine.dialect.name == 'mysql':
+        # InnoDB строит индекс, не блокируя запись в таблицу
+        columns = ', '.join(c.name for c in index.columns)
+        with db.engine.begin() as conn:
+            conn.execute(db.text(f'CREATE INDEX {name} ON {table} ({columns}) ALGORITHM=INPLACE LOCK=NONE'))
+    else:
+        index.create(bind=db.engine)
+    return True
+
+
+@migration(1, 'Количество рецензий и сумма оценок в books')
+def review_stats():
+    added = add_column('books', 'reviews_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column('books', 'rating_sum', 'INTEGER NOT NULL DEFAULT 0')
+    if added:
+        Book.recompute_review_stats()
+        db.session.commit()
+
+
+@migration(2, 'Время изменения книги')
+def book_updated_at():
+    if add_column('books', 'updated_at', 'DATETIME'):
+        with db.engine.begin() as conn:
+            conn.execute(db.text('UPDATE books SET updated_at = :now'), {'now': datetime.utcnow()})
+
+
+@migration(3, 'Индексы для постраничного вывода каталога и очереди модерации')
+def pagination_indexes():
+    create_index('books', 'ix_books_year_id')
+    create_index('reviews', 'ix_reviews_created_at_id')
+
+
+@migration(4, 'Полнотекстовый индекс каталога')
+def fulltext_index():
+    if search.ensure_index():
+        search.reindex_all()
+        db.session.commit()
+
+
+@migration(5, 'Индексы для частых выборок по внешним ключам и хэшу обложки')
+def lookup_indexes():
+    create_index('reviews', 'ix_reviews_book_id_created_at')
+    create_index('reviews', 'ix_reviews_user_id')
+    create_index('covers', 'ix_covers_md5_hash')
+    create_index('covers', 'ix_covers_book_id')
+    create_index('collections', 'ix_collections_user_id')
+    create_index('book_collections', 'ix_book_collections_collection_id')
+    create_index('book_genres', 'ix_book_genres_genre_id')
+
+
+@migration(6, 'Отметка модерации рецензий')
+def review_moderation():
+    add_column('reviews', 'moderated_at', 'DATETIME')
+    create_index('reviews', 'ix_reviews_moderated_at_created_at_id')
+
+
+@migration(7, 'Готовый HTML и выжимка описаний книг и рецензий')
+def rendered_texts():
+    add_column('books', 'description_html', 'TEXT')
+    add_column('books', 'description_excerpt', 'VARCHAR(300)')
+    add_column('reviews', 'text_html', 'TEXT')
+    add_column('reviews', 'text_excerpt', 'VARCHAR(300)')
+    Book.render_descriptions()
+    Review.render_texts()
+
+
+def applied_versions():
+    return set(db.session.scalars(db.select(SchemaMigration.version)))
+
+
+def pending():
+    applied = applied_versions()
+    return [m for m in sorted(MIGRATIONS) if m[0] not in applied]
+
+
+def upgrade(report=None):
+    SchemaMigration.__table__.create(bind=db.engine, checkfirst=True)
+    done = []
+    for version, description, func in pending():
+        func()
+        # Несколько воркеров могут стартовать одновременно: версию записывает первый
+        try:
+            db.session.add(SchemaMigration(version=version, description=description))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        done.append(version)
+        if report:
+            report(f'Применена миграция {version}: {description}')
+    return done
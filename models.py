@@ -1,9 +1,11 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
+from database import RoutingSession
+from passwords import password_hasher
+import rich_text
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class Role(db.Model):
     __tablename__ = 'roles'
@@ -26,10 +28,10 @@ class User(UserMixin, db.Model):
     collections = db.relationship('Collection', backref='user', lazy=True, cascade='all, delete-orphan')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
     
     def get_full_name(self):
         if self.middle_name:
@@ -43,24 +45,120 @@ class Genre(db.Model):
 
 book_genres = db.Table('book_genres',
     db.Column('book_id', db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True),
-    db.Column('genre_id', db.Integer, db.ForeignKey('genres.id', ondelete='CASCADE'), primary_key=True)
+    db.Column('genre_id', db.Integer, db.ForeignKey('genres.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_book_genres_genre_id', 'genre_id')
 )
 
+def render_text_columns(source, html_column, excerpt_column, book_id_column, only_missing=True, batch_size=1000):
+    # Пересчёт готового HTML и выжимки пачками по id; коммит после каждой пачки,
+    # чтобы на большой таблице не держать одну длинную транзакцию. У книг, чей HTML
+    # (описания или рецензии) изменился, сдвигается updated_at: иначе страницы книг
+    # и API отвечали бы 304 и отдавали закэшированные фрагменты со старым HTML
+    table = source.table
+    done = 0
+    last_id = 0
+    while True:
+        stmt = db.select(table.c.id, source, html_column, book_id_column) \
+            .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+        if only_missing:
+            stmt = stmt.where(html_column.is_(None))
+        rows = db.session.execute(stmt).all()
+        if not rows:
+            return done
+        params = []
+        changed = set()
+        for row_id, text, old_html, book_id in rows:
+            html, excerpt = rich_text.prepare(text)
+            params.append({'r_id': row_id, 'r_html': html, 'r_excerpt': excerpt})
+            if html != old_html:
+                changed.add(book_id)
+        db.session.execute(
+            db.update(table).where(table.c.id == db.bindparam('r_id'))
+            .values({html_column: db.bindparam('r_html'), excerpt_column: db.bindparam('r_excerpt')}),
+            params)
+        if changed:
+            db.session.execute(db.update(Book).where(Book.id.in_(changed)).values(updated_at=datetime.utcnow()))
+        db.session.commit()
+        done += len(rows)
+        last_id = rows[-1][0]
+
 class Book(db.Model):
     __tablename__ = 'books'
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(255), nullable=False)
+    # Исходный текст, очищенный HTML для страницы книги и выжимка для списков (см. rich_text.py)
     description = db.Column(db.Text, nullable=False)
+    description_html = db.Column(db.Text)
+    description_excerpt = db.Column(db.String(rich_text.EXCERPT_LENGTH))
     year = db.Column(db.Integer, nullable=False)
     publisher = db.Column(db.String(255), nullable=False)
     author = db.Column(db.String(255), nullable=False)
     pages = db.Column(db.Integer, nullable=False)
+    # Денормализованные агрегаты рецензий, поддерживаются в той же транзакции,
+    # что и добавление/удаление рецензии (см. bump_review_stats)
+    reviews_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Меняется при любом изменении книги или её рецензий, используется для ETag
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
     
     genres = db.relationship('Genre', secondary=book_genres, lazy='subquery',
                            backref=db.backref('books', lazy=True))
     covers = db.relationship('Cover', backref='book', lazy=True, cascade='all, delete-orphan')
     reviews = db.relationship('Review', backref='book', lazy=True, cascade='all, delete-orphan')
     collections = db.relationship('Collection', secondary='book_collections', backref='books')
+    
+    # Для keyset-пагинации каталога по (year, id)
+    __table_args__ = (db.Index('ix_books_year_id', 'year', 'id'),)
+    
+    def set_description(self, source):
+        self.description = source
+        self.description_html, self.description_excerpt = rich_text.prepare(source)
+    
+    @staticmethod
+    def render_descriptions(only_missing=True):
+        books = Book.__table__
+        return render_text_columns(books.c.description, books.c.description_html,
+                                   books.c.description_excerpt, books.c.id, only_missing)
+    
+    @property
+    def avg_rating(self):
+        if not self.reviews_count:
+            return 0
+        return round(self.rating_sum / self.reviews_count, 1)
+    
+    @staticmethod
+    def bump_review_stats(book_id, count_delta, rating_delta):
+        # Инкремент на стороне БД, чтобы параллельные рецензии не теряли обновления
+        db.session.execute(
+            db.update(Book)
+            .where(Book.id == book_id)
+            .values(reviews_count=Book.reviews_count + count_delta,
+                    rating_sum=Book.rating_sum + rating_delta,
+                    updated_at=datetime.utcnow())
+        )
+    
+    @staticmethod
+    def bump_review_stats_many(deltas):
+        # deltas: {book_id: (count_delta, rating_delta)}; один executemany на все книги
+        if not deltas:
+            return
+        books = Book.__table__
+        db.session.execute(
+            db.update(books)
+            .where(books.c.id == db.bindparam('b_id'))
+            .values(reviews_count=books.c.reviews_count + db.bindparam('b_count'),
+                    rating_sum=books.c.rating_sum + db.bindparam('b_rating'),
+                    updated_at=datetime.utcnow()),
+            [{'b_id': book_id, 'b_count': count, 'b_rating': rating}
+             for book_id, (count, rating) in sorted(deltas.items())]
+        )
+    
+    @staticmethod
+    def recompute_review_stats():
+        # Полный пересчёт агрегатов одним UPDATE с коррелированными подзапросами
+        count_q = db.select(db.func.count(Review.id)).where(Review.book_id == Book.id).scalar_subquery()
+        sum_q = db.select(db.func.coalesce(db.func.sum(Review.rating), 0)).where(Review.book_id == Book.id).scalar_subquery()
+        db.session.execute(db.update(Book).values(reviews_count=count_q, rating_sum=sum_q))
 
 class Cover(db.Model):
     __tablename__ = 'covers'
@@ -68,7 +166,28 @@ class Cover(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     mime_type = db.Column(db.String(100), nullable=False)
     md5_hash = db.Column(db.String(32), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False, index=True)
+    
+    # Поиск уже загруженного файла по хэшу при каждой загрузке обложки
+    __table_args__ = (db.Index('ix_covers_md5_hash', 'md5_hash'),)
+    
+    # Миниатюры общие для всех обложек с одинаковым содержимым
+    variants = db.relationship('CoverVariant', viewonly=True, lazy=True,
+                               primaryjoin='foreign(CoverVariant.md5_hash) == Cover.md5_hash',
+                               order_by='CoverVariant.width')
+    
+    def variants_of(self, fmt):
+        return [v for v in self.variants if v.format == fmt]
+
+class CoverVariant(db.Model):
+    __tablename__ = 'cover_variants'
+    id = db.Column(db.Integer, primary_key=True)
+    md5_hash = db.Column(db.String(32), nullable=False, index=True)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    format = db.Column(db.String(10), nullable=False)
+    filename = db.Column(db.String(255), nullable=False, unique=True)
+    mime_type = db.Column(db.String(100), nullable=False)
 
 class Review(db.Model):
     __tablename__ = 'reviews'
@@ -77,17 +196,186 @@ class Review(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)
     text = db.Column(db.Text, nullable=False)
+    text_html = db.Column(db.Text)
+    text_excerpt = db.Column(db.String(rich_text.EXCERPT_LENGTH))
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    # Время одобрения модератором; NULL — рецензия ещё в очереди модерации
+    moderated_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.UniqueConstraint('book_id', 'user_id', name='unique_book_user_review'),
+        # Для keyset-пагинации очереди модерации по (created_at, id)
+        db.Index('ix_reviews_created_at_id', 'created_at', 'id'),
+        # Рецензии книги в порядке добавления и рецензии пользователя
+        db.Index('ix_reviews_book_id_created_at', 'book_id', 'created_at'),
+        db.Index('ix_reviews_user_id', 'user_id'),
+        # Очередь непроверенных рецензий в том же порядке
+        db.Index('ix_reviews_moderated_at_created_at_id', 'moderated_at', 'created_at', 'id'),
+    )
+    
+    def set_text(self, source):
+        self.text = source
+        self.text_html, self.text_excerpt = rich_text.prepare(source)
+    
+    @staticmethod
+    def render_texts(only_missing=True):
+        reviews = Review.__table__
+        return render_text_columns(reviews.c.text, reviews.c.text_html,
+                                   reviews.c.text_excerpt, reviews.c.book_id, only_missing)
+    
+    @staticmethod
+    def delete_many(review_ids):
+        # Удаление пачки рецензий с пересчётом агрегатов по одному разу на книгу.
+        # Возвращает число удалённых рецензий и id затронутых книг.
+        deltas = {
+            book_id: (-count, -rating)
+            for book_id, count, rating in db.session.execute(
+                db.select(Review.book_id, db.func.count(Review.id), db.func.sum(Review.rating))
+                .where(Review.id.in_(review_ids))
+                .group_by(Review.book_id)
+            )
+        }
+        if deltas:
+            db.session.execute(db.delete(Review).where(Review.id.in_(review_ids))
+                               .execution_options(synchronize_session=False))
+            Book.bump_review_stats_many(deltas)
+        return -sum(count for count, _ in deltas.values()), list(deltas)
     
-    __table_args__ = (db.UniqueConstraint('book_id', 'user_id', name='unique_book_user_review'),)
+    @staticmethod
+    def approve_many(review_ids):
+        return db.session.execute(
+            db.update(Review)
+            .where(Review.id.in_(review_ids), Review.moderated_at.is_(None))
+            .values(moderated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+class BookSimilarity(db.Model):
+    # Предрассчитанные top-k похожих книг, см. recommendations.py
+    __tablename__ = 'book_similarities'
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    rank = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    neighbor_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+class SimilarityDirty(db.Model):
+    # Книги, у которых изменились рецензии или подборки с момента последнего пересчёта
+    __tablename__ = 'similarity_dirty'
+    book_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+class BookViewDaily(db.Model):
+    # Просмотры книги за день (UTC), см. popularity.py
+    __tablename__ = 'book_views_daily'
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    views = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_book_views_daily_day', 'day'),
+    )
+
+class BookPopularity(db.Model):
+    # Просмотры за всё время и за скользящее окно последних дней для списков лидеров
+    __tablename__ = 'book_popularity'
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True)
+    total_views = db.Column(db.Integer, nullable=False, default=0)
+    window_views = db.Column(db.Integer, nullable=False, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_book_popularity_total_views', 'total_views'),
+        db.Index('ix_book_popularity_window_views', 'window_views'),
+    )
 
 class Collection(db.Model):
     __tablename__ = 'collections'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(255), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False, index=True)
+    
+    @staticmethod
+    def with_counts(user_id):
+        # Число книг считается в SQL, без загрузки состава подборок
+        rows = db.session.execute(
+            db.select(Collection, db.func.count(book_collections.c.book_id))
+            .outerjoin(book_collections, book_collections.c.collection_id == Collection.id)
+            .where(Collection.user_id == user_id)
+            .group_by(Collection.id)
+            .order_by(Collection.id)
+        ).all()
+        for collection, count in rows:
+            collection.books_count = count
+        return [collection for collection, _ in rows]
+    
+    @staticmethod
+    def memberships(user_id, book_id):
+        # Подборки пользователя с признаком, есть ли в них книга, одним запросом
+        contains = db.exists().where(book_collections.c.collection_id == Collection.id,
+                                     book_collections.c.book_id == book_id)
+        return db.session.execute(
+            db.select(Collection.id, Collection.name, contains.label('contains'))
+            .where(Collection.user_id == user_id)
+            .order_by(Collection.id)
+        ).all()
+    
+    @staticmethod
+    def books_count(collection_id):
+        return db.session.scalar(db.select(db.func.count()).select_from(book_collections)
+                                 .where(book_collections.c.collection_id == collection_id))
+    
+    @staticmethod
+    def add_books(collection_id, book_ids):
+        # INSERT ... SELECT: несуществующие книги и уже добавленные отсеиваются в том же запросе
+        already = db.exists().where(book_collections.c.collection_id == collection_id,
+                                    book_collections.c.book_id == Book.id)
+        source = db.select(Book.id, db.literal(collection_id)) \
+            .where(Book.id.in_(book_ids), ~already)
+        return db.session.execute(
+            db.insert(book_collections).from_select(['book_id', 'collection_id'], source)
+        ).rowcount
+    
+    @staticmethod
+    def remove_books(collection_id, book_ids):
+        return db.session.execute(
+            db.delete(book_collections).where(book_collections.c.collection_id == collection_id,
+                                              book_collections.c.book_id.in_(book_ids))
+        ).rowcount
 
+# Первичный ключ начинается с book_id, для выборки книг подборки нужен отдельный индекс
 book_collections = db.Table('book_collections',
     db.Column('book_id', db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), primary_key=True),
-    db.Column('collection_id', db.Integer, db.ForeignKey('collections.id', ondelete='CASCADE'), primary_key=True)
-)
\ No newline at end of file
+    db.Column('collection_id', db.Integer, db.ForeignKey('collections.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_book_collections_collection_id', 'collection_id')
+)
+
+class ChangeMarker(db.Model):
+    # Отметки времени последних изменений для целых разделов (например, каталога)
+    __tablename__ = 'change_markers'
+    name = db.Column(db.String(50), primary_key=True)
+    changed_at = db.Column(db.DateTime, nullable=False)
+    
+    CATALOGUE = 'catalogue'
+    # Последний пересчёт похожих книг, см. recommendations.py
+    RECOMMENDATIONS = 'recommendations'
+    # Первый день окна, уже учтённого в book_popularity.window_views
+    POPULARITY_WINDOW = 'popularity_window'
+    
+    @staticmethod
+    def touch(name):
+        now = datetime.utcnow()
+        updated = db.session.execute(
+            db.update(ChangeMarker).where(ChangeMarker.name == name).values(changed_at=now)
+        ).rowcount
+        if not updated:
+            db.session.add(ChangeMarker(name=name, changed_at=now))
+        return now
+    
+    @staticmethod
+    def get(name):
+        return db.session.scalar(db.select(ChangeMarker.changed_at).where(ChangeMarker.name == name))
+
+class SchemaMigration(db.Model):
+    # Применённые версии схемы, см. migrations.py
+    __tablename__ = 'schema_migrations'
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(255), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
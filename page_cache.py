@@ -0,0 +1,174 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Кэш отрендеренных фрагментов страниц. Ключи содержат версию данных
+# (отметку изменения каталога или книги), поэтому после коммита старые записи
+# становятся недостижимыми во всех воркерах; invalidate_* дополнительно
+# освобождает место в хранилище.
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete_prefix(self, prefix):
+        pass
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+
+class LRUBackend:
+    # Кэш в памяти процесса с ограничением по числу записей и TTL
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteBackend:
+    # Общее для нескольких воркеров хранилище в отдельном файле SQLite
+    def __init__(self, path, max_entries, ttl):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS page_cache ('
+                         'key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_page_cache_expires ON page_cache (expires)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            'SELECT value FROM page_cache WHERE key = ? AND expires >= ?', (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value):
+        conn = self._connect()
+        conn.execute('INSERT OR REPLACE INTO page_cache (key, value, expires) VALUES (?, ?, ?)',
+                     (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + self.ttl))
+        # Изредка подчищаем просроченные и лишние записи
+        if hash(key) % 64 == 0:
+            conn.execute('DELETE FROM page_cache WHERE expires < ?', (time.time(),))
+            conn.execute('DELETE FROM page_cache WHERE key IN (SELECT key FROM page_cache '
+                         'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def delete_prefix(self, prefix):
+        self._connect().execute('DELETE FROM page_cache WHERE substr(key, 1, ?) = ?',
+                                (len(prefix), prefix))
+
+    def clear(self):
+        self._connect().execute('DELETE FROM page_cache')
+
+    def __len__(self):
+        return self._connect().execute('SELECT count(*) FROM page_cache').fetchone()[0]
+
+
+class PageCache:
+    def __init__(self, app=None):
+        self.backend = NullBackend()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        kind = app.config['PAGE_CACHE_BACKEND']
+        max_entries = app.config['PAGE_CACHE_MAX_ENTRIES']
+        ttl = app.config['PAGE_CACHE_TTL']
+        if kind == 'memory':
+            self.backend = LRUBackend(max_entries, ttl)
+        elif kind == 'sqlite':
+            self.backend = SQLiteBackend(app.config['PAGE_CACHE_PATH'], max_entries, ttl)
+        elif kind in (None, 'none'):
+            self.backend = NullBackend()
+        else:
+            raise ValueError(f'Неизвестный тип кэша страниц: {kind}')
+
+    def get_or_render(self, key, render):
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if value is None:
+            value = render()
+            self.backend.set(key, value)
+        return value
+
+    def invalidate_catalogue(self):
+        self.backend.delete_prefix('index:')
+
+    def invalidate_book(self, book_id):
+        self.backend.delete_prefix(f'book:{book_id}:')
+
+    def after_fork(self):
+        # Соединение SQLite, открытое в мастере, воркеру не годится: он откроет своё
+        if isinstance(self.backend, SQLiteBackend):
+            self.backend._local = threading.local()
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'entries': len(self.backend),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+page_cache = PageCache()
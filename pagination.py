@@ -0,0 +1,99 @@
+import base64
+import json
+from datetime import datetime
+from models import db
+
+# Keyset-пагинация (seek): вместо OFFSET и COUNT(*) продолжаем выборку
+# с последнего показанного ключа сортировки, используя составной индекс.
+# Все ключи сортируются по убыванию, последний ключ должен быть уникальным (id).
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, columns):
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        payload = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor(token)
+    if not isinstance(payload, list) or len(payload) != len(columns):
+        raise InvalidCursor(token)
+    values = []
+    for column, value in zip(columns, payload):
+        try:
+            if column.type.python_type is datetime:
+                value = datetime.fromisoformat(value)
+            else:
+                value = column.type.python_type(value)
+        except (ValueError, TypeError):
+            raise InvalidCursor(token)
+        values.append(value)
+    return values
+
+
+def _seek_condition(columns, values, newer):
+    # (c1, c2) < (v1, v2) в развёрнутом виде, который понимают SQLite и MySQL
+    compare = (lambda c, v: c > v) if newer else (lambda c, v: c < v)
+    condition = compare(columns[-1], values[-1])
+    for column, value in zip(reversed(columns[:-1]), reversed(values[:-1])):
+        condition = db.or_(compare(column, value), db.and_(column == value, condition))
+    return condition
+
+
+def approximate_count(model):
+    # Оценка числа строк без полного COUNT(*)
+    table = model.__table__
+    if db.engine.dialect.name == 'mysql':
+        estimate = db.session.scalar(
+            db.text('SELECT TABLE_ROWS FROM information_schema.TABLES '
+                    'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :name'),
+            {'name': table.name}
+        )
+    else:
+        estimate = db.session.scalar(db.select(db.func.max(table.c.id)))
+    return estimate or 0
+
+
+class KeysetPage:
+    def __init__(self, items, columns, has_next, has_prev, approx_total=None):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.approx_total = approx_total
+        self.next_cursor = self._cursor(items[-1], columns) if items and has_next else None
+        self.prev_cursor = self._cursor(items[0], columns) if items and has_prev else None
+
+    @staticmethod
+    def _cursor(item, columns):
+        return encode_cursor([getattr(item, column.key) for column in columns])
+
+
+def keyset_paginate(query, columns, per_page, after=None, before=None, model=None):
+    if after:
+        values = decode_cursor(after, columns)
+        query = query.filter(_seek_condition(columns, values, newer=False))
+    elif before:
+        values = decode_cursor(before, columns)
+        query = query.filter(_seek_condition(columns, values, newer=True))
+
+    if before:
+        rows = query.order_by(*[c.asc() for c in columns]).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        has_next = True
+    else:
+        rows = query.order_by(*[c.desc() for c in columns]).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = bool(after)
+
+    approx_total = approximate_count(model) if model is not None else None
+    return KeysetPage(items, columns, has_next, has_prev, approx_total)
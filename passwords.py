@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Хэширование паролей вне рабочего потока запроса. Проверка идёт в ограниченном
+# пуле потоков (hashlib отпускает GIL на время PBKDF2/scrypt), число одновременно
+# ожидающих проверок ограничено, при переполнении вход сразу отклоняется.
+# Хэши со старым алгоритмом или стоимостью пересчитываются при успешном входе.
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, app=None):
+        self.method = 'pbkdf2'
+        self.prefix = None
+        self.timeout = 10
+        self._executor = None
+        self._slots = None
+        self.logger = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.prefix = None
+        self.timeout = app.config['PASSWORD_VERIFY_TIMEOUT']
+        self.logger = app.logger
+        workers = app.config['PASSWORD_WORKERS']
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password') if workers else None
+        self._slots = threading.BoundedSemaphore(workers + app.config['PASSWORD_MAX_PENDING']) if workers else None
+
+    def hash(self, password):
+        return generate_password_hash(password, self.method)
+
+    def verify(self, pw_hash, password):
+        return check_password_hash(pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        # Werkzeug дописывает параметры по умолчанию ('pbkdf2' -> 'pbkdf2:sha256:600000'),
+        # поэтому эталонный префикс берём из настоящего хэша при первой проверке
+        if self.prefix is None:
+            self.prefix = self.hash('').split('$', 1)[0]
+        return pw_hash.split('$', 1)[0] != self.prefix
+
+    def _submit(self, func, *args):
+        # Задача в пуле; HasherBusy, если все потоки заняты и очередь заполнена
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        # Слот освобождается по завершении хэширования, даже если запрос не дождался результата
+        future.add_done_callback(self._finished)
+        return future
+
+    def _finished(self, future):
+        self._slots.release()
+        if not future.cancelled() and future.exception() is not None and self.logger:
+            self.logger.error('Ошибка при хэшировании пароля', exc_info=future.exception())
+
+    def check(self, pw_hash, password):
+        if self._executor is None:
+            return self.verify(pw_hash, password)
+        future = self._submit(self.verify, pw_hash, password)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            # Ещё не начатая проверка снимается с очереди; начатая досчитается
+            # и освободит слот сама. Для клиента это та же перегрузка.
+            future.cancel()
+            raise HasherBusy()
+
+    def rehash_later(self, password, save):
+        # Пересчёт хэша со старыми параметрами без ожидания: save(new_hash) вызывается
+        # в потоке пула. False — пул занят, хэш обновится при одном из следующих входов.
+        if self._executor is None:
+            save(self.hash(password))
+            return True
+        try:
+            self._submit(lambda: save(self.hash(password)))
+        except HasherBusy:
+            return False
+        return True
+
+
+class LoginThrottle:
+    # Скользящее окно неудачных попыток в памяти процесса, отдельно на логин и на IP.
+    # Успешные входы не считаются: целый класс за одним NAT может войти одновременно.
+    def __init__(self, app=None):
+        self.window = 300
+        self.max_per_login = 5
+        self.max_per_ip = 50
+        self._failures = {}
+        self._ip_failures = {}
+        self._lock = threading.Lock()
+        self._pruned = time.monotonic()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.window = app.config['LOGIN_THROTTLE_WINDOW']
+        self.max_per_login = app.config['LOGIN_MAX_FAILURES']
+        self.max_per_ip = app.config['LOGIN_MAX_FAILURES_PER_IP']
+
+    def _recent(self, store, key, now):
+        events = store.get(key)
+        if events is None:
+            return None
+        while events and events[0] <= now - self.window:
+            events.popleft()
+        return events
+
+    def retry_after(self, login, ip):
+        # Сколько секунд ждать до следующей попытки; 0 — можно пробовать
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            wait = 0
+            for store, key, limit in ((self._failures, login.lower(), self.max_per_login),
+                                      (self._ip_failures, ip, self.max_per_ip)):
+                events = self._recent(store, key, now)
+                if events and len(events) >= limit:
+                    wait = max(wait, events[0] + self.window - now)
+            return int(wait) + 1 if wait else 0
+
+    def failed(self, login, ip):
+        now = time.monotonic()
+        with self._lock:
+            self._failures.setdefault(login.lower(), deque()).append(now)
+            self._ip_failures.setdefault(ip, deque()).append(now)
+
+    def succeeded(self, login):
+        with self._lock:
+            self._failures.pop(login.lower(), None)
+
+    def _prune(self, now):
+        if now - self._pruned < self.window:
+            return
+        self._pruned = now
+        for store in (self._failures, self._ip_failures):
+            for key in [k for k, events in store.items() if not events or events[-1] <= now - self.window]:
+                del store[key]
+
+
+password_hasher = PasswordHasher()
+login_throttle = LoginThrottle()
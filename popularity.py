@@ -0,0 +1,181 @@
+import atexit
+import os
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy.dialects import mysql, sqlite
+from models import db, Book, BookViewDaily, BookPopularity, ChangeMarker
+
+# Счётчики просмотров книг. Просмотр — это только увеличение счётчика в памяти
+# воркера; раз в VIEW_FLUSH_INTERVAL секунд фоновый поток пишет накопленное пачкой:
+# прибавляет к строкам book_views_daily (книга, день) и к итогам в book_popularity.
+# Все записи — атомарные прибавления (INSERT ... ON CONFLICT DO UPDATE), поэтому
+# несколько воркеров не теряют чужие обновления. Окно «за последние дни» хранится
+# готовым в book_popularity.window_views и сдвигается раз в сутки: из него
+# вычитаются только выпавшие дни.
+
+
+def _increment(table, rows, columns):
+    # Вставка строк или прибавление к существующим, одним executemany
+    if not rows:
+        return
+    if db.engine.dialect.name == 'mysql':
+        stmt = mysql.insert(table)
+        stmt = stmt.on_duplicate_key_update({c: table.c[c] + stmt.inserted[c] for c in columns})
+    else:
+        stmt = sqlite.insert(table)
+        stmt = stmt.on_conflict_do_update(index_elements=[c.name for c in table.primary_key],
+                                          set_={c: table.c[c] + stmt.excluded[c] for c in columns})
+    db.session.execute(stmt, rows)
+
+
+def _as_datetime(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def rebuild(start):
+    # Полный пересчёт book_popularity по дневной таблице
+    daily = BookViewDaily.__table__
+    window = db.func.sum(db.case((daily.c.day >= start, daily.c.views), else_=0))
+    db.session.execute(db.delete(BookPopularity))
+    db.session.execute(db.insert(BookPopularity).from_select(
+        ['book_id', 'total_views', 'window_views'],
+        db.select(daily.c.book_id, db.func.sum(daily.c.views), window).group_by(daily.c.book_id)))
+    marker = db.session.get(ChangeMarker, ChangeMarker.POPULARITY_WINDOW)
+    if marker is None:
+        db.session.add(ChangeMarker(name=ChangeMarker.POPULARITY_WINDOW, changed_at=_as_datetime(start)))
+    else:
+        marker.changed_at = _as_datetime(start)
+
+
+def advance_window(current, start):
+    # Условный UPDATE отметки: выпавшие дни вычитает только один из воркеров
+    moved = db.session.execute(
+        db.update(ChangeMarker)
+        .where(ChangeMarker.name == ChangeMarker.POPULARITY_WINDOW, ChangeMarker.changed_at == current)
+        .values(changed_at=_as_datetime(start))
+    ).rowcount
+    if not moved:
+        return
+    daily = BookViewDaily.__table__
+    expired = db.session.execute(
+        db.select(daily.c.book_id, db.func.sum(daily.c.views))
+        .where(daily.c.day >= current.date(), daily.c.day < start)
+        .group_by(daily.c.book_id)
+    ).all()
+    if expired:
+        popularity = BookPopularity.__table__
+        db.session.execute(
+            db.update(popularity)
+            .where(popularity.c.book_id == db.bindparam('p_id'))
+            .values(window_views=popularity.c.window_views - db.bindparam('p_views')),
+            [{'p_id': book_id, 'p_views': views} for book_id, views in expired])
+
+
+def leaders(column, limit):
+    # Книги с наибольшим значением column; порядок берётся из индекса book_popularity
+    return db.session.execute(
+        db.select(Book.id, Book.title, Book.author, column)
+        .join(BookPopularity, BookPopularity.book_id == Book.id)
+        .where(column > 0)
+        .order_by(column.desc(), Book.id)
+        .limit(limit)
+    ).all()
+
+
+def forget_book(book_id):
+    db.session.execute(db.delete(BookViewDaily).where(BookViewDaily.book_id == book_id))
+    db.session.execute(db.delete(BookPopularity).where(BookPopularity.book_id == book_id))
+
+
+class ViewCounter:
+    def __init__(self, app=None):
+        self.app = None
+        self.interval = 10
+        self.window_days = 7
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = app.config['VIEW_FLUSH_INTERVAL']
+        self.window_days = app.config['POPULAR_WINDOW_DAYS']
+
+    def window_start(self):
+        return datetime.utcnow().date() - timedelta(days=self.window_days - 1)
+
+    def record(self, book_id):
+        key = (book_id, datetime.utcnow().date())
+        with self._lock:
+            self._pending[key] += 1
+            # Поток записи свой у каждого процесса: после fork потоки мастера не существуют
+            started = self._pid == os.getpid()
+            self._pid = os.getpid()
+        if self.interval <= 0:
+            self.flush()
+        elif not started:
+            threading.Thread(target=self._flush_periodically, name='view-counter', daemon=True).start()
+            atexit.register(self.flush)
+
+    def pending(self):
+        with self._lock:
+            return sum(self._pending.values())
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending:
+            return 0
+        try:
+            with self.app.app_context():
+                self._write(pending)
+        except Exception:
+            # Не записанные просмотры возвращаются в буфер до следующей попытки
+            with self._lock:
+                self._pending.update(pending)
+            raise
+        return sum(pending.values())
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Не удалось записать просмотры книг')
+
+    def _write(self, pending):
+        # Книгу могли удалить, пока её просмотры копились в памяти
+        book_ids = {book_id for book_id, _ in pending}
+        existing = set(db.session.scalars(db.select(Book.id).where(Book.id.in_(book_ids))))
+        start = self.window_start()
+        totals, window = Counter(), Counter()
+        daily = []
+        for (book_id, day), views in sorted(pending.items()):
+            if book_id not in existing:
+                continue
+            daily.append({'book_id': book_id, 'day': day, 'views': views})
+            totals[book_id] += views
+            if day >= start:
+                window[book_id] += views
+
+        _increment(BookViewDaily.__table__, daily, ['views'])
+        current = ChangeMarker.get(ChangeMarker.POPULARITY_WINDOW)
+        if current is None:
+            # Первая запись: итоги строятся по дневной таблице, включая только что записанное
+            rebuild(start)
+        else:
+            if current.date() < start:
+                advance_window(current, start)
+            _increment(BookPopularity.__table__,
+                       [{'book_id': book_id, 'total_views': views, 'window_views': window[book_id]}
+                        for book_id, views in totals.items()],
+                       ['total_views', 'window_views'])
+        db.session.commit()
+
+
+view_counter = ViewCounter()
@@ -0,0 +1,76 @@
+import re
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from models import db
+from page_cache import page_cache, NullBackend
+
+# Проверка планов выполнения: страницы открываются тестовым клиентом, все их
+# SELECT-запросы прогоняются через EXPLAIN (QUERY PLAN), и полный просмотр
+# таблицы без индекса считается ошибкой. Небольшие справочники читаются целиком
+# намеренно и в проверке не учитываются.
+
+SMALL_TABLES = {'roles', 'genres', 'change_markers', 'schema_migrations'}
+_ALIAS = re.compile(r'\b(\w+)\s+AS\s+(\w+)\b', re.IGNORECASE)
+
+
+def capture(app, pages):
+    # pages: список (id пользователя или None, url)
+    captured = {}
+    current = [None]
+
+    def collect(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith('SELECT'):
+            captured.setdefault((conn.engine, statement), (current[0], parameters))
+
+    backend, page_cache.backend = page_cache.backend, NullBackend()
+    event.listen(Engine, 'before_cursor_execute', collect)
+    try:
+        for user_id, url in pages:
+            client = app.test_client()
+            if user_id is not None:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+            current[0] = url
+            # Свой контекст приложения на каждый запрос: иначе g (и current_user)
+            # был бы общим со внешним контекстом, например команды CLI
+            with app.app_context():
+                response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError(f'{url}: ответ {response.status_code}')
+    finally:
+        event.remove(Engine, 'before_cursor_execute', collect)
+        page_cache.backend = backend
+    return [(url, engine, statement, parameters)
+            for (engine, statement), (url, parameters) in captured.items()]
+
+
+def _table(name, statement):
+    if name in db.metadata.tables:
+        return name
+    for table, alias in _ALIAS.findall(statement):
+        if alias == name and table in db.metadata.tables:
+            return table
+    # Подзапрос или CTE: их строки уже проверены в плане основной таблицы
+    return None
+
+
+def full_scans(engine, statement, parameters):
+    with engine.connect() as conn:
+        if engine.dialect.name == 'mysql':
+            rows = conn.exec_driver_sql('EXPLAIN ' + statement, parameters).mappings()
+            scanned = [row['table'] for row in rows if row['type'] == 'ALL']
+        else:
+            rows = conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)
+            scanned = [row[3].split()[1] for row in rows
+                       if row[3].startswith('SCAN ') and 'INDEX' not in row[3] and 'PRIMARY KEY' not in row[3]]
+    tables = (_table(name, statement) for name in scanned)
+    return sorted({t for t in tables if t and t not in SMALL_TABLES})
+
+
+def check(app, pages):
+    problems = []
+    for url, engine, statement, parameters in capture(app, pages):
+        for table in full_scans(engine, statement, parameters):
+            problems.append((url, table, statement))
+    return problems
@@ -0,0 +1,199 @@
+import numpy as np
+from scipy import sparse
+from models import db, Book, Review, BookSimilarity, SimilarityDirty, ChangeMarker, book_genres, book_collections
+
+# Рекомендации «похожие книги»: item-item косинусная близость по совместной
+# встречаемости в подборках и у одних и тех же рецензентов, с бонусом за общие
+# жанры. Для каждой книги храним top-k соседей в book_similarities.
+
+TOP_K = 10
+BLOCK_SIZE = 1024
+YIELD_PER = 10000
+COLLECTION_WEIGHT = 1.0
+REVIEW_WEIGHT = 1.0
+GENRE_BONUS = 0.1
+INSERT_BATCH = 5000
+
+
+def _read_pairs(stmt):
+    # Пары (книга, признак[, вес]) читаются потоком прямо в массивы numpy
+    rows = db.session.execute(stmt.execution_options(yield_per=YIELD_PER))
+    chunks = [np.asarray(partition, dtype=np.float64) for partition in rows.partitions()]
+    if not chunks:
+        return np.empty((0, len(stmt.selected_columns)))
+    return np.concatenate(chunks)
+
+
+def _index(values):
+    uniques, inverse = np.unique(values.astype(np.int64), return_inverse=True)
+    return uniques, inverse
+
+
+def build_matrices():
+    book_ids = np.fromiter(db.session.scalars(db.select(Book.id).order_by(Book.id)), dtype=np.int64)
+    position = {int(book_id): i for i, book_id in enumerate(book_ids)}
+    n_books = len(book_ids)
+
+    def to_rows(ids):
+        return np.searchsorted(book_ids, ids.astype(np.int64))
+
+    blocks = []
+    collections = _read_pairs(db.select(book_collections.c.book_id, book_collections.c.collection_id))
+    collections = collections[np.isin(collections[:, 0], book_ids)] if len(collections) else collections
+    if len(collections):
+        _, cols = _index(collections[:, 1])
+        blocks.append(sparse.csr_matrix(
+            (np.full(len(cols), COLLECTION_WEIGHT), (to_rows(collections[:, 0]), cols)),
+            shape=(n_books, cols.max() + 1)))
+
+    # Оценка 0 («ужасно») не считается сигналом похожести
+    reviews = _read_pairs(db.select(Review.book_id, Review.user_id, Review.rating).where(Review.rating > 0))
+    reviews = reviews[np.isin(reviews[:, 0], book_ids)] if len(reviews) else reviews
+    if len(reviews):
+        _, cols = _index(reviews[:, 1])
+        blocks.append(sparse.csr_matrix(
+            (REVIEW_WEIGHT * reviews[:, 2] / 5.0, (to_rows(reviews[:, 0]), cols)),
+            shape=(n_books, cols.max() + 1)))
+
+    if blocks:
+        features = sparse.hstack(blocks, format='csr')
+    else:
+        features = sparse.csr_matrix((n_books, 1))
+    norms = np.sqrt(np.asarray(features.multiply(features).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    features = sparse.diags(1.0 / norms) @ features
+
+    genres = _read_pairs(db.select(book_genres.c.book_id, book_genres.c.genre_id))
+    genres = genres[np.isin(genres[:, 0], book_ids)] if len(genres) else genres
+    if len(genres):
+        _, cols = _index(genres[:, 1])
+        genre_matrix = sparse.csr_matrix(
+            (np.ones(len(cols)), (to_rows(genres[:, 0]), cols)), shape=(n_books, cols.max() + 1))
+    else:
+        genre_matrix = sparse.csr_matrix((n_books, 1))
+
+    return book_ids, position, features.tocsr(), genre_matrix.tocsr()
+
+
+def _popular_by_genre(book_ids, genre_matrix, k):
+    # Запасной вариант для книг без совместной встречаемости: популярные книги тех же жанров
+    counts = dict(db.session.execute(db.select(Book.id, Book.reviews_count)).all())
+    popularity = np.array([counts.get(int(b), 0) for b in book_ids], dtype=np.float64)
+    genre_csc = genre_matrix.tocsc()
+    top = {}
+    for genre in range(genre_matrix.shape[1]):
+        members = genre_csc.indices[genre_csc.indptr[genre]:genre_csc.indptr[genre + 1]]
+        order = members[np.argsort(-popularity[members], kind='stable')]
+        top[genre] = order[:k + 1]
+    return top
+
+
+def compute_neighbours(rows, book_ids, features, genre_matrix, k=TOP_K):
+    features_t = features.T.tocsc()
+    fallback = _popular_by_genre(book_ids, genre_matrix, k)
+    for start in range(0, len(rows), BLOCK_SIZE):
+        block_rows = rows[start:start + BLOCK_SIZE]
+        similarity = (features[block_rows] @ features_t).tocsr()
+        for offset, row in enumerate(block_rows):
+            cols = similarity.indices[similarity.indptr[offset]:similarity.indptr[offset + 1]]
+            scores = similarity.data[similarity.indptr[offset]:similarity.indptr[offset + 1]]
+            keep = cols != row
+            cols, scores = cols[keep], scores[keep]
+            book_genres_row = genre_matrix[row]
+            if len(cols):
+                overlap = np.asarray(genre_matrix[cols] @ book_genres_row.T.toarray()).ravel()
+                scores = scores + GENRE_BONUS * (overlap > 0)
+                if len(cols) > k:
+                    best = np.argpartition(-scores, k)[:k]
+                    cols, scores = cols[best], scores[best]
+                order = np.argsort(-scores, kind='stable')
+                cols, scores = cols[order], scores[order]
+            if len(cols) < k:
+                seen = set(cols.tolist()) | {row}
+                extra = [c for g in book_genres_row.indices for c in fallback.get(g, ()) if c not in seen]
+                extra = list(dict.fromkeys(extra))[:k - len(cols)]
+                cols = np.concatenate([cols, np.asarray(extra, dtype=cols.dtype)])
+                scores = np.concatenate([scores, np.zeros(len(extra))])
+            yield int(book_ids[row]), [(int(book_ids[c]), float(s)) for c, s in zip(cols, scores)]
+
+
+def _store(neighbours):
+    batch = []
+    for book_id, items in neighbours:
+        batch.extend({'book_id': book_id, 'rank': rank, 'neighbor_id': neighbor_id, 'score': score}
+                     for rank, (neighbor_id, score) in enumerate(items))
+        if len(batch) >= INSERT_BATCH:
+            db.session.execute(db.insert(BookSimilarity), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(BookSimilarity), batch)
+
+
+def rebuild(k=TOP_K):
+    book_ids, _, features, genre_matrix = build_matrices()
+    db.session.execute(db.delete(BookSimilarity))
+    db.session.execute(db.delete(SimilarityDirty))
+    _store(compute_neighbours(np.arange(len(book_ids)), book_ids, features, genre_matrix, k))
+    # Страницы книг и API проверяют свежесть и по этой отметке
+    ChangeMarker.touch(ChangeMarker.RECOMMENDATIONS)
+    db.session.commit()
+    return len(book_ids)
+
+
+def refresh(k=TOP_K):
+    # Пересчитываем изменившиеся книги и все книги, делящие с ними подборки или рецензентов
+    dirty = list(db.session.scalars(db.select(SimilarityDirty.book_id)))
+    if not dirty:
+        return 0
+    book_ids, position, features, genre_matrix = build_matrices()
+    dirty_rows = np.array([position[b] for b in dirty if b in position], dtype=np.int64)
+    affected = set(dirty_rows.tolist())
+    if len(dirty_rows):
+        affected.update(np.unique((features[dirty_rows] @ features.T).tocsr().indices).tolist())
+    rows = np.array(sorted(affected), dtype=np.int64)
+    affected_ids = [int(book_ids[r]) for r in rows] + [b for b in dirty if b not in position]
+
+    for start in range(0, len(affected_ids), INSERT_BATCH):
+        db.session.execute(db.delete(BookSimilarity)
+                           .where(BookSimilarity.book_id.in_(affected_ids[start:start + INSERT_BATCH])))
+    _store(compute_neighbours(rows, book_ids, features, genre_matrix, k))
+    db.session.execute(db.delete(SimilarityDirty).where(SimilarityDirty.book_id.in_(dirty)))
+    ChangeMarker.touch(ChangeMarker.RECOMMENDATIONS)
+    db.session.commit()
+    return len(rows)
+
+
+def mark_dirty(*book_ids):
+    # Два запроса на любое число книг: какие уже помечены и вставка остальных
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    marked = set(db.session.scalars(db.select(SimilarityDirty.book_id)
+                                    .where(SimilarityDirty.book_id.in_(book_ids))))
+    missing = sorted(book_ids - marked)
+    if missing:
+        db.session.execute(db.insert(SimilarityDirty), [{'book_id': book_id} for book_id in missing])
+
+
+def forget_book(book_id):
+    db.session.execute(db.delete(BookSimilarity).where(BookSimilarity.book_id == book_id))
+
+
+def similar_for(book_ids, limit=TOP_K):
+    # Соседи для нескольких книг одним запросом по первичному ключу (book_id, rank)
+    neighbor = db.aliased(Book)
+    rows = db.session.execute(
+        db.select(BookSimilarity.book_id, BookSimilarity.score, neighbor.id, neighbor.title, neighbor.author)
+        .join(neighbor, neighbor.id == BookSimilarity.neighbor_id)
+        .where(BookSimilarity.book_id.in_(book_ids), BookSimilarity.rank < limit)
+        .order_by(BookSimilarity.book_id, BookSimilarity.rank)
+    )
+    result = {book_id: [] for book_id in book_ids}
+    for row in rows:
+        result[row.book_id].append({'id': row.id, 'title': row.title, 'author': row.author,
+                                    'score': round(row.score, 4)})
+    return result
+
+
+def similar_books(book_id, limit=TOP_K):
+    return similar_for([book_id], limit)[book_id]
@@ -0,0 +1,36 @@
+import html
+from functools import lru_cache
+import bleach
+
+# Описания книг и тексты рецензий хранятся в трёх видах: исходный текст, как его
+# ввёл пользователь (для форм редактирования), готовый очищенный HTML для страниц
+# и короткая текстовая выжимка для списков. HTML и выжимка считаются один раз при
+# записи, страницы выводят их как есть и не разбирают текст заново.
+
+EXCERPT_LENGTH = 300
+MEMO_SIZE = 1024
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def render(source):
+    # Единственное место, где текст превращается в HTML; сюда же встанет разметка,
+    # когда она понадобится. Кэш по содержимому: одинаковые тексты при импорте
+    # и пересчёте не очищаются повторно
+    return bleach.clean(source or '')
+
+
+def plain_text(value):
+    return html.unescape(bleach.clean(value or '', tags=[], strip=True))
+
+
+def excerpt(source, length=EXCERPT_LENGTH):
+    text = ' '.join(plain_text(source).split())
+    if len(text) <= length:
+        return text
+    # Обрезаем по границе слова
+    cut = text[:length - 1].rsplit(' ', 1)[0] or text[:length - 1]
+    return cut.rstrip(' ,.;:-') + '…'
+
+
+def prepare(source):
+    return render(source), excerpt(source)
@@ -0,0 +1,170 @@
+import math
+import re
+from rich_text import plain_text
+from models import db, Book, Genre, book_genres
+
+# Полнотекстовый поиск по каталогу: FTS5 для SQLite, FULLTEXT-индекс для MySQL
+
+PER_PAGE = 10
+REINDEX_BATCH_SIZE = 1000
+FTS_TABLE = 'books_fts'
+MYSQL_FULLTEXT_INDEX = 'ft_books'
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def ensure_index():
+    # Возвращает True, если индекс только что создан и его нужно наполнить
+    inspector = db.inspect(db.engine)
+    if _dialect() == 'sqlite':
+        if FTS_TABLE in inspector.get_table_names():
+            return False
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                "title, author, publisher, description, "
+                "tokenize='unicode61 remove_diacritics 2')"
+            ))
+        return True
+    if _dialect() == 'mysql':
+        if any(i['name'] == MYSQL_FULLTEXT_INDEX for i in inspector.get_indexes('books')):
+            return False
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                f'ALTER TABLE books ADD FULLTEXT INDEX {MYSQL_FULLTEXT_INDEX} '
+                '(title, author, publisher, description)'
+            ))
+        return True
+    return False
+
+
+def _index_rows(rows):
+    rows = list(rows)
+    if not rows:
+        return
+    db.session.execute(
+        db.text(f'INSERT INTO {FTS_TABLE} (rowid, title, author, publisher, description) '
+                'VALUES (:id, :title, :author, :publisher, :description)'),
+        [{'id': row.id, 'title': row.title, 'author': row.author,
+          'publisher': row.publisher, 'description': plain_text(row.description)}
+         for row in rows]
+    )
+
+
+def index_book(book):
+    # MySQL обновляет FULLTEXT-индекс сам, синхронизировать нужно только FTS5
+    if _dialect() != 'sqlite':
+        return
+    remove_book(book.id)
+    _index_rows([book])
+
+
+def index_books(rows):
+    # Пакетная индексация строк (id, title, author, publisher, description)
+    if _dialect() != 'sqlite':
+        return
+    _index_rows(rows)
+
+
+def remove_book(book_id):
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(db.text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :id'), {'id': book_id})
+
+
+def reindex_all(batch_size=REINDEX_BATCH_SIZE):
+    if _dialect() != 'sqlite':
+        return
+    db.session.execute(db.text(f'DELETE FROM {FTS_TABLE}'))
+    stmt = db.select(Book.id, Book.title, Book.author, Book.publisher, Book.description) \
+        .order_by(Book.id).execution_options(yield_per=batch_size)
+    for partition in db.session.execute(stmt).partitions():
+        _index_rows(partition)
+    db.session.execute(db.text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')"))
+
+
+def _match_expression(query):
+    tokens = TOKEN_RE.findall(query or '')
+    if not tokens:
+        return None
+    if _dialect() == 'sqlite':
+        return ' '.join(f'"{token}"*' for token in tokens)
+    return ' '.join(f'+{token}*' for token in tokens)
+
+
+def _matches(expression):
+    # Подзапрос (book_id, score): чем больше score, тем релевантнее
+    if _dialect() == 'sqlite':
+        sql = (f'SELECT rowid AS book_id, -bm25({FTS_TABLE}, 10.0, 8.0, 2.0, 1.0) AS score '
+               f'FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :q')
+    else:
+        against = 'MATCH (title, author, publisher, description) AGAINST (:q IN BOOLEAN MODE)'
+        sql = f'SELECT id AS book_id, {against} AS score FROM books WHERE {against}'
+    return db.text(sql).bindparams(q=expression) \
+        .columns(book_id=db.Integer, score=db.Float).subquery('matches')
+
+
+def _decade_expr():
+    return Book.year - Book.year % 10
+
+
+def search_books(query, genre_id=None, decade=None, page=1, per_page=PER_PAGE):
+    result = {'query': query or '', 'books': [], 'total': 0, 'page': page,
+              'pages': 0, 'per_page': per_page, 'genres': [], 'decades': []}
+    expression = _match_expression(query)
+    if expression is None:
+        return result
+
+    matches = _matches(expression)
+    genre_filter = Book.id.in_(
+        db.select(book_genres.c.book_id).where(book_genres.c.genre_id == genre_id)
+    ) if genre_id else db.true()
+    decade_filter = _decade_expr() == decade if decade is not None else db.true()
+
+    total = db.session.scalar(
+        db.select(db.func.count()).select_from(Book)
+        .join(matches, matches.c.book_id == Book.id)
+        .where(genre_filter, decade_filter)
+    )
+    result['total'] = total
+    result['pages'] = math.ceil(total / per_page) if total else 0
+    if total:
+        result['books'] = db.session.scalars(
+            db.select(Book)
+            .options(db.defer(Book.description), db.defer(Book.description_html))
+            .join(matches, matches.c.book_id == Book.id)
+            .where(genre_filter, decade_filter)
+            .order_by(matches.c.score.desc(), Book.id)
+            .limit(per_page).offset((page - 1) * per_page)
+        ).all()
+
+    # Фасеты считаются с учётом фильтра по другому измерению
+    result['genres'] = [
+        {'id': row.id, 'name': row.name, 'count': row.hits}
+        for row in db.session.execute(
+            db.select(Genre.id, Genre.name, db.func.count().label('hits'))
+            .select_from(matches)
+            .join(book_genres, book_genres.c.book_id == matches.c.book_id)
+            .join(Genre, Genre.id == book_genres.c.genre_id)
+            .join(Book, Book.id == matches.c.book_id)
+            .where(decade_filter)
+            .group_by(Genre.id, Genre.name)
+            .order_by(db.func.count().desc(), Genre.name)
+        )
+    ]
+    decade_col = _decade_expr().label('decade')
+    result['decades'] = [
+        {'decade': row.decade, 'count': row.hits}
+        for row in db.session.execute(
+            db.select(decade_col, db.func.count().label('hits'))
+            .select_from(Book)
+            .join(matches, matches.c.book_id == Book.id)
+            .where(genre_filter)
+            .group_by(decade_col)
+            .order_by(decade_col.desc())
+        )
+    ]
+    return result
@@ -0,0 +1,92 @@
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+from gunicorn.app.base import BaseApplication
+
+# Боевой сервер: gunicorn с предзагрузкой приложения. Мастер один раз импортирует
+# приложение и готовит базу, затем форкает воркеры — код, шаблоны и справочники
+# остаются в общих страницах памяти (copy-on-write). В лог пишутся время старта
+# и память каждого воркера: RSS, PSS (с долей общих страниц) и собственная память.
+
+
+def process_uptime():
+    # Сколько секунд прошло с запуска процесса (Linux); None, если /proc недоступен
+    try:
+        with open('/proc/self/stat') as f:
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def memory_usage(pid='self'):
+    # Память процесса в байтах: rss, pss и private (не разделяемая с другими процессами)
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    usage = {}
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in fields:
+                    usage[fields[key]] = usage.get(fields[key], 0) + int(value.split()[0]) * 1024
+    except OSError:
+        # Не Linux: только пиковый RSS, в macOS он в байтах, в остальных системах в КБ
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'max_rss': peak if sys.platform == 'darwin' else peak * 1024}
+    return usage
+
+
+def format_memory(usage):
+    return ', '.join(f'{key} {value / 1024 / 1024:.1f} МБ' for key, value in usage.items())
+
+
+class Server(BaseApplication):
+    def __init__(self, factory, options, after_fork=None, memory_report=0):
+        self.factory = factory
+        self.options = options
+        self.after_fork = after_fork
+        self.memory_report = memory_report
+        self.load_seconds = None
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('when_ready', self.when_ready)
+        self.cfg.set('post_fork', self.post_fork)
+        self.cfg.set('post_worker_init', self.post_worker_init)
+
+    def load(self):
+        started = time.perf_counter()
+        application = self.factory()
+        # Объекты, созданные при загрузке, сборщик мусора больше не обходит и не
+        # меняет их заголовки — страницы с ними не копируются в каждый воркер
+        gc.collect()
+        gc.freeze()
+        self.load_seconds = time.perf_counter() - started
+        return application
+
+    def when_ready(self, server):
+        uptime = process_uptime()
+        server.log.info('Приложение загружено за %.2f с, мастер готов через %s после запуска; память мастера: %s',
+                        self.load_seconds or 0, f'{uptime:.2f} с' if uptime is not None else '?',
+                        format_memory(memory_usage()))
+
+    def post_fork(self, server, worker):
+        if self.after_fork:
+            self.after_fork()
+
+    def post_worker_init(self, worker):
+        worker.log.info('Воркер %s запущен; память: %s', worker.pid, format_memory(memory_usage()))
+        if self.memory_report:
+            threading.Thread(target=self._report_memory, args=(worker,), daemon=True).start()
+
+    def _report_memory(self, worker):
+        while True:
+            time.sleep(self.memory_report)
+            worker.log.info('Воркер %s: %s', worker.pid, format_memory(memory_usage()))